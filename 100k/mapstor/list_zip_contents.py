@@ -2,48 +2,108 @@
 # requires-python = ">=3.12"
 # dependencies = [
 #     "remotezip",
+#     "requests",
 # ]
 # ///
 
-import sys
+import io
 import csv
-import remotezip
+import time
+import argparse
+import requests
+from pathlib import Path
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from requests.adapters import HTTPAdapter
 
-def get_zip_file_list(url):
+from zip_index import ZipIndex
+
+def get_session(workers):
+    # one pool of kept alive connections per host, shared by all the workers
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=16, pool_maxsize=workers)
+    session.mount('https://', adapter)
+    session.mount('http://', adapter)
+    return session
+
+def get_zip_file_list(url, zip_index, retries=3):
     """
     Returns a list of files in a remote zip file without downloading the whole file.
     """
-    try:
-        with remotezip.RemoteZip(url) as zip:
-            return [name for name in zip.namelist()]
-    except Exception as e:
-        print(f"Error processing {url}: {e}")
-        return []
+    for attempt in range(retries + 1):
+        try:
+            listing = zip_index.get(url)
+            return [member['name'] for member in listing['members']]
+        except Exception as e:
+            if attempt == retries:
+                print(f"Error processing {url}: {e}")
+                return None
+            delay = 2 ** attempt
+            print(f"Error processing {url}: {e}, retrying in {delay} secs")
+            time.sleep(delay)
+
+def get_listed_urls(output_file):
+    listed = set()
+    if not output_file.exists():
+        return listed
+    with open(output_file, 'r', newline='') as f:
+        reader = csv.reader(f)
+        next(reader, None)
+        for row in reader:
+            if row:
+                listed.add(row[0])
+    return listed
 
 def main():
-    if len(sys.argv) != 3:
-        print("Usage: python list_zip_contents.py <input_file> <output_file>")
-        sys.exit(1)
+    parser = argparse.ArgumentParser(description='list the contents of remote zip files into a csv')
+    parser.add_argument('input_file', help='file with one zip url per line')
+    parser.add_argument('output_file', help='csv file to write url,filename rows to')
+    parser.add_argument('--workers', type=int, default=8, help='number of zips to list in parallel')
+    parser.add_argument('--retries', type=int, default=3, help='number of retries for a failing zip')
+    parser.add_argument('--refresh', action='store_true', help='check the etags of cached zip listings and reread the changed ones')
+    args = parser.parse_args()
 
-    input_file = sys.argv[1]
-    output_file = sys.argv[2]
+    output_file = Path(args.output_file)
 
-    with open(input_file, 'r') as f_in, open(output_file, 'w', newline='') as f_out:
-        writer = csv.writer(f_out)
-        writer.writerow(["url", "filename"])
+    urls = [ url.strip() for url in Path(args.input_file).read_text().split('\n') if url.strip() != '' ]
+    urls = list(dict.fromkeys(urls))
 
-        for url in f_in:
-            url = url.strip()
-            if not url:
-                continue
+    # the csv is written as we go, so urls listed by an earlier run can be skipped
+    listed = get_listed_urls(output_file)
+    pending = [ url for url in urls if url not in listed ]
+    print(f"{len(urls)} urls, {len(urls) - len(pending)} already listed, {len(pending)} to list")
 
-            print(f"Processing {url}...")
-            files = get_zip_file_list(url)
+    new_file = not output_file.exists() or output_file.stat().st_size == 0
+    session = get_session(args.workers)
+    zip_index = ZipIndex(session, refresh=args.refresh)
+    failed = []
+    done = 0
+    with open(output_file, 'a', newline='') as f_out, ThreadPoolExecutor(args.workers) as executor:
+        if new_file:
+            csv.writer(f_out).writerow(["url", "filename"])
+
+        futures = { executor.submit(get_zip_file_list, url, zip_index, args.retries): url for url in pending }
+        for future in as_completed(futures):
+            url = futures[future]
+            files = future.result()
+            done += 1
+            if files is None:
+                failed.append(url)
+                continue
+            # all the rows of a zip go out in one write, a killed run doesn't leave a zip half listed
+            buf = io.StringIO()
+            writer = csv.writer(buf)
             for file in files:
                 writer.writerow([url, file])
+            f_out.write(buf.getvalue())
+            f_out.flush()
+            print(f"{done}/{len(pending)} listed {len(files)} files in {url}")
 
-    print(f"CSV file '{output_file}' created successfully.")
+    if failed:
+        print(f"Failed to list {len(failed)} zips, rerun to retry them:")
+        for url in failed:
+            print(url)
+    print(f"zip listings: {zip_index.hits} from cache, {zip_index.misses} fetched")
+    print(f"CSV file '{output_file}' updated successfully.")
 
 if __name__ == "__main__":
     main()
-
@@ -12,21 +12,41 @@
 
 
 import os
+import time
 import json
+import argparse
 import traceback
 from pathlib import Path
+from functools import partial
 
+import numpy as np
 from PIL import Image
-from pyproj import Transformer
 
 from topo_map_processor.processor import TopoMapProcessor
 
-from ozi_map import ozi_reader
+from sheet_runner import run_sheets, DiskBudget
+from failure_log import FailureLog, get_failure_record
+from sheet_state import get_sheet_state, get_input_hash
+from gdal_backend import run_in_process, get_gdal
+from map_index import get_map_data, update_map_index
+from workdir_policy import RETENTION_POLICIES, KEEP_NONE_AFTER_EXPORT, get_retention_policy, get_inter_dir_override, get_watched_dirs, cleanup_after_warp, cleanup_after_export
+from image_probe import update_image_manifest
+from crs_registry import get_transformer, coords_to_pixels, transform_points, get_stats_str
 
 class GSMapstorProcessor(TopoMapProcessor):
 
     def __init__(self, filepath, extra, index_box, index_properties, id_override=None):
         super().__init__(filepath, extra, index_box, index_properties)
+        self.running_cmd = None
+        self.sheet_state = None
+        self.input_hash = None
+        self.redo_stages = False
+        # run the gdal commands through the osgeo.gdal api instead of shelling out
+        self.gdal_in_process = os.getenv('GDAL_IN_PROCESS', '0') == '1'
+        # georeference straight from the source gif/jpg instead of a q100 full.jpg re-encode
+        self.direct_source = os.getenv('DIRECT_SOURCE', '0') == '1' and not self.inset_pixel_cutlines
+        # how much of the workdir is left behind after the warp and the export
+        self.retention = get_retention_policy()
         self.id_override = id_override
         self.mapfile_processed = False
         self.mapfile_title = None
@@ -46,52 +66,133 @@ class GSMapstorProcessor(TopoMapProcessor):
             return self.id_override
         return super().get_id()
 
+    def get_inter_dir(self):
+        inter_dir = get_inter_dir_override()
+        if inter_dir is not None:
+            return inter_dir
+        return super().get_inter_dir()
+
+    def run_external(self, cmd):
+        # when running in a worker pool, only use this worker's share of the cores
+        worker_threads = os.environ.get('GDAL_WORKER_THREADS', None)
+        if worker_threads is not None:
+            cmd = cmd.replace('ALL_CPUS', worker_threads)
+        # remembered for the failure log
+        self.running_cmd = cmd
+        if self.gdal_in_process:
+            run_in_process(cmd)
+        else:
+            super().run_external(cmd)
+        self.running_cmd = None
+
+    def is_stage_done(self, stage, output_file):
+        if self.redo_stages:
+            return False
+        return self.sheet_state.is_done(self.get_id(), stage, self.input_hash, output_file)
+
+    def run_stage(self, stage, output_file, fn):
+        if self.sheet_state is None:
+            fn()
+            return
+
+        sheet_id = self.get_id()
+        if self.is_stage_done(stage, output_file):
+            print(f'{stage} already done for {sheet_id}.. skipping')
+            return
+
+        # anything on disk without a completion record is left over from an interrupted run
+        if output_file.exists():
+            print(f'{output_file} was not recorded as complete.. redoing {stage}')
+            output_file.unlink()
+
+        # everything downstream of a redone stage has to be redone as well
+        self.redo_stages = True
+
+        self.sheet_state.mark_started(sheet_id, stage, self.input_hash)
+        start = time.time()
+        fn()
+        end = time.time()
+        self.sheet_state.mark_done(sheet_id, stage, self.input_hash, output_file, end - start)
+
+    def process(self):
+        if self.sheet_state is None:
+            return super().process()
+
+        sheet_id = self.get_id()
+        export_file = self.get_export_file()
+        if export_file.exists() and not self.sheet_state.has_sheet(sheet_id):
+            # exported before the state db existed
+            self.sheet_state.mark_done(sheet_id, 'export', self.input_hash, export_file, None)
+            return True
+
+        workdir = self.get_workdir()
+        final_file = workdir.joinpath('final.tif')
+
+        # the earlier stages are only needed to get to final.tif, and their outputs may have been cleaned up already
+        if not self.is_stage_done('warp', final_file):
+            # georeference() skips if there is a final.tif around
+            if final_file.exists():
+                final_file.unlink()
+
+            def rotate():
+                self.remove_insets()
+                self.rotate()
+
+            self.run_stage('rotate', self.get_converted_file(), rotate)
+
+            # pause to debug
+            self.prompt1()
+
+            self.run_stage('georeference', workdir.joinpath('georef.tif'), self.georeference)
+        self.run_stage('warp', final_file, self.warp)
+        cleanup_after_warp(workdir, self.retention)
+        self.run_stage('export', export_file, self.export)
+
+        # pause to debug
+        self.prompt2()
+
+        cleanup_after_export(workdir, self.retention)
+        return True
+
     def get_resolution(self):
         return "auto"
 
     def get_original_pixel_coordinate(self, p):
         return p
 
-    def transform_datum_to_wgs84(self, ref):
-        # use pyproj to transform from Pulkovo 1942 (2) to WGS84
-        transformer = Transformer.from_crs("EPSG:4284", "EPSG:4326", always_xy=True)
-        lon, lat = transformer.transform(ref['x'], ref['y'])
-        return {'x': lon, 'y': lat}
+    def transform_datum_to_wgs84(self, points):
+        # use pyproj to transform from Pulkovo 1942 (2) to WGS84, all the points in one call
+        transformer = get_transformer('EPSG:4284', 'EPSG:4326')
+        return transform_points(transformer, points)
 
     def get_gcps(self, pre_rotated=False):
         if self.corner_gcps is not None:
             gcps = []
             for gcp in self.corner_gcps:
-                ref = { 'x': gcp['lon'], 'y': gcp['lat'] }
-                if self.work_in_wgs84:
-                    ref = self.transform_datum_to_wgs84(ref)
                 gcps.append([(gcp['x'], gcp['y']),
-                             (ref['x'], ref['y'])])
+                             (gcp['lon'], gcp['lat'])])
             if self.other_gcps is not None:
                 for gcp in self.other_gcps:
-                    ref = { 'x': gcp['lon'], 'y': gcp['lat'] }
-                    if self.work_in_wgs84:
-                        ref = self.transform_datum_to_wgs84(ref)
                     gcps.append([(gcp['x'], gcp['y']),
-                                 (ref['x'], ref['y'])])
-
-            return gcps
+                                 (gcp['lon'], gcp['lat'])])
+        else:
+            self.process_map_file()
+            if self.ozi_gcps is None:
+                raise ValueError("GCPs not available")
 
-        self.process_map_file()
-        if self.ozi_gcps is None:
-            raise ValueError("GCPs not available")
+            gcps = []
+            for ozi_gcp in self.ozi_gcps:
+                if ozi_gcp['type'] != 'latlon':
+                    raise ValueError(f"Unsupported GCP type: {ozi_gcp['type']}")
 
-        gcps = []
-        for ozi_gcp in self.ozi_gcps:
-            if ozi_gcp['type'] != 'latlon':
-                raise ValueError(f"Unsupported GCP type: {ozi_gcp['type']}")
+                pixel = ozi_gcp['pixel']
+                ref = ozi_gcp['ref']
+                gcps.append([(pixel['x'], pixel['y']),
+                             (ref['x'], ref['y'])])
 
-            pixel = ozi_gcp['pixel']
-            ref = ozi_gcp['ref']
-            if self.work_in_wgs84:
-                ref = self.transform_datum_to_wgs84(ref)
-            gcps.append([(pixel['x'], pixel['y']),
-                         (ref['x'], ref['y'])])
+        if self.work_in_wgs84:
+            refs = self.transform_datum_to_wgs84([gcp[1] for gcp in gcps])
+            gcps = [ [gcp[0], ref] for gcp, ref in zip(gcps, refs) ]
         return gcps
 
     def get_sheet_ibox(self):
@@ -99,12 +200,9 @@ class GSMapstorProcessor(TopoMapProcessor):
             return self.cutline_override
 
         if self.corner_gcps is not None:
-            corners = []
-            for gcp in self.corner_gcps:
-                ref = {'x': gcp['lon'], 'y': gcp['lat']}
-                if self.work_in_wgs84:
-                    ref = self.transform_datum_to_wgs84(ref)
-                corners.append((ref['x'], ref['y']))
+            corners = [ (gcp['lon'], gcp['lat']) for gcp in self.corner_gcps ]
+            if self.work_in_wgs84:
+                corners = self.transform_datum_to_wgs84(corners)
             corners = corners + [corners[0]]
             return corners
 
@@ -117,11 +215,7 @@ class GSMapstorProcessor(TopoMapProcessor):
         if self.cutline_override is not None:
             gcps = self.get_gcps()
             transformer = self.get_transformer_from_gcps(gcps)
-            corners = []
-            for corner in self.cutline_override:
-                x, y = transformer.rowcol(corner[0], corner[1])
-                corners.append((x, y))
-            return corners[:-1]
+            return coords_to_pixels(transformer, self.cutline_override[:-1])
 
         if self.corner_gcps is not None:
             corners = []
@@ -136,8 +230,7 @@ class GSMapstorProcessor(TopoMapProcessor):
     def process_map_file(self):
         if self.mapfile_processed:
             return
-        map_filepath = self.filepath.with_suffix('.map')
-        map_data = ozi_reader.read_ozi_map(open(map_filepath, 'rb'))
+        map_data = get_map_data(self.filepath.with_suffix('.map'))
 
         self.index_properties['maptitle'] = map_data.get('title', '')
 
@@ -159,7 +252,7 @@ class GSMapstorProcessor(TopoMapProcessor):
 
         workdir = self.get_workdir()
 
-        full_img_path = workdir / 'full.jpg'
+        full_img_path = self.get_converted_file()
 
         if full_img_path.exists():
             return
@@ -167,9 +260,42 @@ class GSMapstorProcessor(TopoMapProcessor):
         self.ensure_dir(workdir)
 
         img = Image.open(self.filepath)
+
+        if self.direct_source:
+            # describe the rgb conversion in a vrt and let gdal read the source directly
+            if img.mode == 'P':
+                band_options = '-expand rgb'
+            elif img.mode == 'L':
+                band_options = '-b 1 -b 1 -b 1'
+            else:
+                band_options = '-b 1 -b 2 -b 3'
+            self.run_external(f'gdal_translate -of VRT {band_options} {str(self.filepath.resolve())} {str(full_img_path)}')
+            return
+
         rgb_img = img.convert('RGB')
         rgb_img.save(full_img_path, format='JPEG', subsampling=0, quality=100)
 
+    def get_converted_file(self):
+        workdir = self.get_workdir()
+        if self.direct_source:
+            return workdir / 'full.vrt'
+        return workdir / 'full.jpg'
+
+    def get_full_file_path(self):
+        converted_file = self.get_converted_file()
+        if self.direct_source and converted_file.exists():
+            return converted_file
+        return super().get_full_file_path()
+
+    def get_full_img(self):
+        if self.full_img is not None or not self.direct_source:
+            return super().get_full_img()
+
+        # opencv can't read the vrt, decode the source instead
+        img = Image.open(self.filepath).convert('RGB')
+        self.full_img = np.array(img)[:, :, ::-1]
+        return self.full_img
+
 
     def get_crs_proj(self):
         #self.process_map_file()
@@ -194,7 +320,56 @@ def get_bad_sheet_ids():
         bad_sheet_ids = [ line.strip() for line in f.readlines() if line.strip() != '' ]
     return bad_sheet_ids
 
-def process_files():
+def get_sheet_tasks(image_files, special_cases, sheet_map, bad_sheet_ids):
+    tasks = []
+    for filepath in image_files:
+        extra = special_cases.get(filepath.name, {})
+        id = filepath.name.replace('.gif', '')
+        if id in bad_sheet_ids:
+            continue
+        sheet_props = sheet_map[id]
+        sheet_props['source_type'] = 'mapstor'
+
+        subs = []
+        if 'parts' not in extra:
+            subs.append([id, extra])
+        else:
+            for i, part in enumerate(extra['parts']):
+                subs.append([f'{id}-part{i}', part])
+
+        for subid, subextra in subs:
+            tasks.append((filepath, subid, subextra, sheet_props))
+    return tasks
+
+def process_sheet(task, interactive=True):
+    filepath, subid, subextra, sheet_props = task
+
+    sheet_state = get_sheet_state()
+    input_hash = get_input_hash(filepath, subextra)
+    processor = GSMapstorProcessor(filepath, subextra, [], sheet_props, id_override=subid)
+    # the export has to still be there and of the recorded size, deleting it is how a sheet gets redone
+    if sheet_state.is_done(subid, 'export', input_hash, processor.get_export_file()):
+        return subid, True, None
+
+    processor.sheet_state = sheet_state
+    processor.input_hash = input_hash
+
+    try:
+        processor.process()
+
+        #filepath.unlink()
+        #filepath.with_suffix('.map').unlink()
+        return subid, True, None
+    except Exception as ex:
+        print(f'parsing {filepath} failed with exception: {ex}')
+        traceback.print_exc()
+        failure = get_failure_record(subid, filepath, ex, processor.running_cmd)
+        if interactive:
+            #raise
+            processor.prompt()
+        return subid, False, failure
+
+def process_files(workers=1, batch=False, retry_failed=False, skip_bad_images=False, min_free_gb=None):
     
     data_dir = Path('mapstor/data/raw')
     
@@ -219,50 +394,57 @@ def process_files():
 
     bad_sheet_ids = get_bad_sheet_ids()
 
-    total = len(image_files)
-    processed_count = 0
-    failed_count = 0
-    success_count = 0
-    # Process each file
-    for filepath in image_files:
-        print(f'==========  Processed: {processed_count}/{total} Success: {success_count} Failed: {failed_count} processing {filepath.name} ==========')
-        extra = special_cases.get(filepath.name, {})
-        id = filepath.name.replace('.gif', '')
-        if id in bad_sheet_ids:
-            continue
-        sheet_props = sheet_map[id]
-        sheet_props['source_type'] = 'mapstor'
+    # parse all the .map files once up front instead of in every processor
+    update_map_index(data_dir)
 
-        subs = []
-        if 'parts' not in extra:
-            subs.append([id, extra])
-        else:
-            for i, part in enumerate(extra['parts']):
-                subs.append([f'{id}-part{i}', part])
+    # truncated downloads are flagged here, instead of failing in the middle of a warp
+    bad_images = update_image_manifest(data_dir).get_bad(image_files)
+    if bad_images:
+        print(f'{len(bad_images)} truncated or unreadable images, see `python image_probe.py {data_dir}`: {" ".join(sorted(bad_images))}')
+        if skip_bad_images:
+            image_files = [ f for f in image_files if f.name not in bad_images ]
 
-        for subid, subextra in subs:
-            try:
-                processor = GSMapstorProcessor(filepath, subextra, [], sheet_props, id_override=subid)
-                processor.process()
-                exit(0)
-
-                #filepath.unlink()
-                #filepath.with_suffix('.map').unlink()
-                success_count += 1
-            except Exception as ex:
-                print(f'parsing {filepath} failed with exception: {ex}')
-                failed_count += 1
-                traceback.print_exc()
-                exit(0)
-                raise
-                processor.prompt()
-            processed_count += 1
-
-    print(f"Processed {processed_count} images, failed_count {failed_count}, success_count {success_count}")
+    tasks = get_sheet_tasks(image_files, special_cases, sheet_map, bad_sheet_ids)
+
+    failure_log = FailureLog(data_dir.parent / 'failures.jsonl')
+    if retry_failed:
+        failed_ids = failure_log.get_failed_ids()
+        tasks = [ task for task in tasks if task[1] in failed_ids ]
+        print(f'retrying {len(tasks)} failed sheets')
+
+    interactive = not batch and workers <= 1
+    disk_budget = None
+    if min_free_gb is not None:
+        disk_budget = DiskBudget(get_watched_dirs(), min_free_gb * 1024 ** 3)
+    run_sheets(tasks, partial(process_sheet, interactive=interactive), workers=workers, failure_log=failure_log, disk_budget=disk_budget)
+    if workers <= 1:
+        print(get_stats_str())
 
 
 if __name__ == "__main__":
     import os
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--workers', type=int, default=1, help='number of sheets to process in parallel')
+    parser.add_argument('--batch', action='store_true', help='record failures in the failure log and keep going instead of stopping')
+    parser.add_argument('--retry-failed', action='store_true', help='only process the sheets in the failure log')
+    parser.add_argument('--skip-bad-images', action='store_true', help='leave out the images which the header probe finds truncated or unreadable')
+    parser.add_argument('--gdal-in-process', action='store_true', help='run gdal through its python api instead of the command line tools, needs the gdal bindings of the installed gdal, like `uv run --with gdal==$(gdal-config --version)`')
+    parser.add_argument('--direct-source', action='store_true', help='read the source image through a vrt instead of converting it to full.jpg')
+    parser.add_argument('--retention', choices=RETENTION_POLICIES, default=KEEP_NONE_AFTER_EXPORT, help='what to keep of the per sheet workdirs, keep-final keeps just what export needs once the warp is done (default: %(default)s)')
+    parser.add_argument('--min-free-gb', type=float, default=None, help='hold back new sheets while the free space for the workdirs or the exports is below this')
+    parser.add_argument('--inter-dir', default=None, help='put the per sheet workdirs here instead of data/inter, like on a tmpfs')
+    args = parser.parse_args()
+    if args.direct_source:
+        os.environ['DIRECT_SOURCE'] = '1'
+    if args.gdal_in_process:
+        os.environ['GDAL_IN_PROCESS'] = '1'
+    if os.getenv('GDAL_IN_PROCESS', '0') == '1':
+        try:
+            get_gdal()
+        except ImportError as ex:
+            parser.error(str(ex))
+    os.environ['WORKDIR_RETENTION'] = args.retention
+    if args.inter_dir is not None:
+        os.environ['INTER_DIR'] = args.inter_dir
     os.environ['GDAL_PAM_ENABLED'] = 'NO'
-    process_files()
- 
+    process_files(workers=args.workers, batch=args.batch, retry_failed=args.retry_failed, skip_bad_images=args.skip_bad_images, min_free_gb=args.min_free_gb)
@@ -1,114 +1,242 @@
 import csv
 import json
-from pathlib import Path
 import re
+import sys
+import shutil
+import argparse
+from functools import lru_cache
+from pathlib import Path
+
+SKIP_SUFFIXES = ('/', '--coverage.gif', '.kml', '.html', 'mapstor.gif')
+
+YEAR_PAREN_RE = re.compile(r'\((\d{4}(?:-\d{4})?)\)')
+YEAR_UNDERSCORE_RE = re.compile(r'_(\d{4}(?:-\d{4})?)_')
+
+# Regex to find map IDs like 'l37-129' or 'p35-143_144'
+ID_RE = re.compile(r'[a-zA-Z]{1,2}\d{2}[\d_]*')
+ID_PREFIX_RE = re.compile(r'([a-zA-Z]{1,2})')
 
 def should_skip(fname):
-    if fname.endswith('/'):
-        return True
-    if fname.endswith('--coverage.gif'):
-        return True
-    if fname.endswith('.kml'):
-        return True
-    if fname.endswith('.html'):
-        return True
-    if fname.endswith('mapstor.gif'):
-        return True
-    return False
+    return fname.endswith(SKIP_SUFFIXES)
 
 def extract_year(text):
     """Extracts year or year range like (1980) or (1980-1985) from a string."""
     # For cases like (1980) or (1980-1985)
-    match = re.search(r'\((\d{4}(?:-\d{4})?)\)', text)
+    match = YEAR_PAREN_RE.search(text)
     if match:
         return match.group(1)
     
     # For cases like _1980-1980_ or _1980_
-    match = re.search(r'_(\d{4}(?:-\d{4})?)_', text)
+    match = YEAR_UNDERSCORE_RE.search(text)
     if match:
         return match.group(1)
     return None
 
-# Read all file entries from the CSV
-all_files = {}
-with open('data/zip_files.csv', 'r') as csvfile:
-    reader = csv.DictReader(csvfile)
-    for row in reader:
-        fname = row['filename']
-        url = row['url']
-        if should_skip(fname):
-            continue
-        all_files[fname] = { 'url': url }
-
-by_id = {}
-# Process only gif files to find the best map sheet for each ID
-for fname, data in all_files.items():
-    if not fname.endswith('.gif'):
-        continue
-
-    gif_filename = Path(fname).name
+def get_part_ids(part):
+    ids = []
+    for full_match in ID_RE.finditer(part):
+        match = ID_PREFIX_RE.match(full_match.group(0))
+        if match:
+            prefix = match.group(1).upper()
+            numbers_part = part[len(prefix):]
+            
+            for num_str in numbers_part.split('_'):
+                if num_str.isdigit():
+                    map_id = f"{prefix}{num_str}"
+                    if map_id not in ids:
+                        ids.append(map_id)
+    return ids
+
+@lru_cache(maxsize=None)
+def parse_part(part):
+    # the zip name parts repeat for every file in a zip, so each distinct part is only parsed once
+    return extract_year(part), tuple(get_part_ids(part))
+
+@lru_cache(maxsize=None)
+def get_zip_parts(url):
+    return Path(url).stem.split('--')
+
+def get_candidate(fname, url):
+    gif_filename = fname.rsplit('/', 1)[-1]
     print(gif_filename)
     
     # As per user request, split filename to find parts
     # We also consider the zip file name from the URL
-    zip_filename_stem = Path(data['url']).stem
-    parts = gif_filename.removesuffix('.gif').split('--') + zip_filename_stem.split('--')
+    parts = gif_filename.removesuffix('.gif').split('--') + get_zip_parts(url)
 
     ids = []
     year = None
 
     # Extract IDs and Year from the parts
     for part in parts:
+        part_year, part_ids = parse_part(part)
         if not year:
-            year = extract_year(part)
-
-        # Regex to find map IDs like 'l37-129' or 'p35-143_144'
-        # This pattern must match the entire part
-
-        for full_match in re.finditer(r'[a-zA-Z]{1,2}\d{2}[\d_]*', part):
-            match = re.match(r'([a-zA-Z]{1,2})', full_match.group(0))
-            if match:
-                prefix = match.group(1).upper()
-                numbers_part = part[len(prefix):]
-                
-                for num_str in numbers_part.split('_'):
-                    if num_str.isdigit():
-                        map_id = f"{prefix}{num_str}"
-                        if map_id not in ids:
-                            ids.append(map_id)
+            year = part_year
+        for map_id in part_ids:
+            if map_id not in ids:
+                ids.append(map_id)
 
     if not ids:
         print(f"Skipping {gif_filename} as it has no discernible ID.")
-        continue
+        return None
 
     if not year:
         print(f"Skipping {gif_filename} as it has no year information.")
-        continue
+        return None
 
     year_parts = year.split('-')
     if len(year_parts) == 2 and year_parts[0] == year_parts[-1]:
         year = year_parts[0]
 
-    year_for_comparison = int(year.split('-')[0])
-
-    map_id = '_'.join(sorted(ids))
-    if map_id in by_id:
-        print('Duplicate ID found:', map_id, 'in', gif_filename, 'and', by_id[map_id]['filename'])
-        prev_year_str = by_id[map_id]['year']
-        prev_year_for_comparison = int(prev_year_str.split('-')[0])
-        if prev_year_for_comparison >= year_for_comparison:
-            # Existing map is newer or same year, so we keep it
-            continue
-    
-    # This is the best map for this ID so far
-    by_id[map_id] = {
-        'url': data['url'],
+    return '_'.join(sorted(ids)), year, gif_filename
+
+def filter_files(csv_path, only_ids=None):
+    """
+    Streams the zip listing and keeps the best map sheet for each ID, the one with the latest year.
+    Returns a dict of ID to (year_for_comparison, year, url, gif_filename, fname).
+    If only_ids is given, the other IDs are ignored.
+    """
+    by_id = {}
+    with open(csv_path, 'r', newline='') as csvfile:
+        reader = csv.reader(csvfile)
+        header = next(reader)
+        url_idx = header.index('url')
+        fname_idx = header.index('filename')
+        for row in reader:
+            if not row:
+                continue
+            fname = row[fname_idx]
+            # Process only gif files to find the best map sheet for each ID
+            if should_skip(fname) or not fname.endswith('.gif'):
+                continue
+
+            # every file of a zip shares the one url string
+            url = sys.intern(row[url_idx])
+            candidate = get_candidate(fname, url)
+            if candidate is None:
+                continue
+            map_id, year, gif_filename = candidate
+            if only_ids is not None and map_id not in only_ids:
+                continue
+            year_for_comparison = int(year.split('-')[0])
+
+            prev = by_id.get(map_id)
+            # the same member can show up in several edition zips, its year then comes from the zip name,
+            # so every listing is compared, whichever zip comes first in the csv
+            if prev is not None:
+                if prev[4] != fname:
+                    print('Duplicate ID found:', map_id, 'in', gif_filename, 'and', prev[3])
+                if prev[0] >= year_for_comparison:
+                    # Existing map is newer or same year, so we keep it
+                    continue
+
+            # This is the best map for this ID so far
+            by_id[map_id] = (year_for_comparison, year, url, gif_filename, fname)
+    return by_id
+
+def get_entry(map_id, best):
+    _, year, url, gif_filename, _ = best
+    return {
+        'url': url,
         'year': year,
         'filename': gif_filename,
         'id': map_id
     }
 
-print(f"Found {len(by_id)} unique IDs")
+def write_sheet_map(sheet_map, out_path):
+    # same output as json.dumps(..., indent=2, sort_keys=True), without building it all in memory
+    out_path = Path(out_path)
+    tmp_path = out_path.with_name(out_path.name + '.tmp')
+    with open(tmp_path, 'w') as f:
+        if not sheet_map:
+            f.write('{}')
+        for i, map_id in enumerate(sorted(sheet_map.keys())):
+            f.write('{\n' if i == 0 else ',\n')
+            f.write(f'  {json.dumps(map_id)}: ')
+            f.write(json.dumps(sheet_map[map_id], indent=2, sort_keys=True).replace('\n', '\n  '))
+        if sheet_map:
+            f.write('\n}')
+    tmp_path.replace(out_path)
+
+def read_gif_rows(csv_path):
+    rows = set()
+    with open(csv_path, 'r', newline='') as csvfile:
+        reader = csv.reader(csvfile)
+        header = next(reader)
+        url_idx = header.index('url')
+        fname_idx = header.index('filename')
+        for row in reader:
+            if not row:
+                continue
+            fname = row[fname_idx]
+            if should_skip(fname) or not fname.endswith('.gif'):
+                continue
+            rows.add((sys.intern(row[url_idx]), fname))
+    return rows
+
+def get_affected_ids(prev_csv_path, csv_path):
+    """
+    IDs with a gif added to or removed from the listing since prev_csv_path,
+    only their best map sheet can have changed.
+    """
+    prev_rows = read_gif_rows(prev_csv_path)
+    rows = read_gif_rows(csv_path)
+    changed_rows = rows ^ prev_rows
+    print(f"{len(rows - prev_rows)} gifs added and {len(prev_rows - rows)} removed since the last run")
+
+    affected = set()
+    for url, fname in changed_rows:
+        candidate = get_candidate(fname, url)
+        if candidate is not None:
+            affected.add(candidate[0])
+    return affected
+
+def get_changes(old_sheet_map, sheet_map):
+    return {
+        'added': sorted(k for k in sheet_map.keys() if k not in old_sheet_map),
+        'replaced': sorted(k for k in sheet_map.keys() if k in old_sheet_map and old_sheet_map[k] != sheet_map[k]),
+        'removed': sorted(k for k in old_sheet_map.keys() if k not in sheet_map),
+    }
 
-# Write the result to a JSON file
-Path('data/sheet_map.json').write_text(json.dumps(by_id, indent=2, sort_keys=True))
+def main():
+    parser = argparse.ArgumentParser(description='pick the best map sheet for each id from data/zip_files.csv')
+    parser.add_argument('--incremental', action='store_true',
+                        help='only redo the ids touched by the changes in the listing since the last run')
+    args = parser.parse_args()
+
+    csv_path = Path('data/zip_files.csv')
+    # the listing as of the last run, to diff against
+    prev_csv_path = Path('data/zip_files.prev.csv')
+    sheet_map_path = Path('data/sheet_map.json')
+
+    old_sheet_map = {}
+    if sheet_map_path.exists():
+        old_sheet_map = json.loads(sheet_map_path.read_text())
+
+    if args.incremental and prev_csv_path.exists() and sheet_map_path.exists():
+        affected = get_affected_ids(prev_csv_path, csv_path)
+        print(f"Recomputing {len(affected)} affected IDs")
+        by_id = filter_files(csv_path, only_ids=affected)
+        sheet_map = { k: v for k, v in old_sheet_map.items() if k not in affected }
+    else:
+        by_id = filter_files(csv_path)
+        sheet_map = {}
+    for map_id, best in by_id.items():
+        sheet_map[map_id] = get_entry(map_id, best)
+
+    print(f"Found {len(sheet_map)} unique IDs")
+
+    # Write the result to a JSON file
+    write_sheet_map(sheet_map, sheet_map_path)
+    Path('data/sheet_ids.txt').write_text(''.join(f'{k}\n' for k in sorted(sheet_map.keys())))
+
+    # the changeset drives what download_files.py --changes fetches and what gets reprocessed
+    changes = get_changes(old_sheet_map, sheet_map)
+    Path('data/sheet_changes.json').write_text(json.dumps(changes, indent=2))
+    Path('data/changed_files.txt').write_text(''.join(f'{k}.gif\n' for k in changes['added'] + changes['replaced']))
+    print(f"{len(changes['added'])} added, {len(changes['replaced'])} replaced, {len(changes['removed'])} removed")
+
+    shutil.copyfile(csv_path, prev_csv_path)
+
+if __name__ == '__main__':
+    main()
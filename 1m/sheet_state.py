@@ -0,0 +1,152 @@
+import os
+import sys
+import json
+import time
+import sqlite3
+import hashlib
+import argparse
+from pathlib import Path
+
+STATE_FILE = Path('data/sheet_state.db')
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS stages (
+    sheet_id TEXT NOT NULL,
+    stage TEXT NOT NULL,
+    status TEXT NOT NULL,
+    input_hash TEXT,
+    output_file TEXT,
+    output_size INTEGER,
+    duration REAL,
+    updated_at REAL,
+    PRIMARY KEY (sheet_id, stage)
+);
+CREATE TABLE IF NOT EXISTS sheet_values (
+    sheet_id TEXT NOT NULL,
+    name TEXT NOT NULL,
+    input_hash TEXT NOT NULL,
+    value TEXT NOT NULL,
+    updated_at REAL,
+    PRIMARY KEY (sheet_id, name, input_hash)
+)
+'''
+
+_states = {}
+
+
+def get_sheet_state(db_file=STATE_FILE):
+    # sqlite connections can't be shared across forked workers, so keep one per process
+    key = (os.getpid(), str(db_file))
+    if key not in _states:
+        _states[key] = SheetState(db_file)
+    return _states[key]
+
+
+def get_input_hash(filepath, extra):
+    # cheap fingerprint of the sheet inputs, the image and .map files are not read
+    hasher = hashlib.sha256()
+    hasher.update(json.dumps(extra, sort_keys=True).encode('utf-8'))
+    for p in [filepath, filepath.with_suffix('.map')]:
+        if not p.exists():
+            continue
+        st = p.stat()
+        hasher.update(f'{p.name}:{st.st_size}:{st.st_mtime_ns}'.encode('utf-8'))
+    return hasher.hexdigest()
+
+
+def get_params_hash(*params):
+    # fingerprint of the json serializable inputs of a derived value
+    return hashlib.sha256(json.dumps(params).encode('utf-8')).hexdigest()
+
+
+class SheetState:
+    def __init__(self, db_file=STATE_FILE):
+        self.db_file = Path(db_file)
+        self.db_file.parent.mkdir(parents=True, exist_ok=True)
+        self.conn = sqlite3.connect(self.db_file, timeout=60)
+        self.conn.execute('PRAGMA journal_mode=WAL')
+        self.conn.executescript(SCHEMA)
+        self.conn.commit()
+
+    def get(self, sheet_id, stage):
+        cur = self.conn.execute('SELECT status, input_hash, output_size FROM stages WHERE sheet_id = ? AND stage = ?',
+                                (sheet_id, stage))
+        return cur.fetchone()
+
+    def has_sheet(self, sheet_id):
+        cur = self.conn.execute('SELECT 1 FROM stages WHERE sheet_id = ? LIMIT 1', (sheet_id,))
+        return cur.fetchone() is not None
+
+    def is_done(self, sheet_id, stage, input_hash, output_file=None):
+        row = self.get(sheet_id, stage)
+        if row is None:
+            return False
+        status, recorded_hash, output_size = row
+        if status != 'done' or recorded_hash != input_hash:
+            return False
+        if output_file is None:
+            return True
+        output_file = Path(output_file)
+        if not output_file.exists():
+            return False
+        # catches outputs truncated or replaced after they were recorded
+        return output_size is None or output_file.stat().st_size == output_size
+
+    def mark_started(self, sheet_id, stage, input_hash):
+        self.conn.execute('INSERT OR REPLACE INTO stages VALUES (?, ?, ?, ?, ?, ?, ?, ?)',
+                          (sheet_id, stage, 'running', input_hash, None, None, None, time.time()))
+        self.conn.commit()
+
+    def mark_done(self, sheet_id, stage, input_hash, output_file, duration):
+        output_file = Path(output_file)
+        output_size = output_file.stat().st_size if output_file.exists() else None
+        self.conn.execute('INSERT OR REPLACE INTO stages VALUES (?, ?, ?, ?, ?, ?, ?, ?)',
+                          (sheet_id, stage, 'done', input_hash, str(output_file), output_size, duration, time.time()))
+        self.conn.commit()
+
+    def get_value(self, sheet_id, name, input_hash):
+        # values derived from the sheet inputs, which are worth keeping across runs
+        cur = self.conn.execute('SELECT value FROM sheet_values WHERE sheet_id = ? AND name = ? AND input_hash = ?',
+                                (sheet_id, name, input_hash))
+        row = cur.fetchone()
+        if row is None:
+            return None
+        return json.loads(row[0])
+
+    def set_value(self, sheet_id, name, input_hash, value):
+        self.conn.execute('INSERT OR REPLACE INTO sheet_values VALUES (?, ?, ?, ?, ?)',
+                          (sheet_id, name, input_hash, json.dumps(value), time.time()))
+        self.conn.commit()
+
+    def get_sheets(self, stage, status):
+        cur = self.conn.execute('SELECT sheet_id FROM stages WHERE stage = ? AND status = ? ORDER BY sheet_id',
+                                (stage, status))
+        return [ row[0] for row in cur.fetchall() ]
+
+    def get_summary(self):
+        cur = self.conn.execute('SELECT stage, status, COUNT(*), SUM(duration), SUM(output_size) FROM stages GROUP BY stage, status ORDER BY stage, status')
+        return cur.fetchall()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='query the per sheet pipeline state')
+    parser.add_argument('--db', default=str(STATE_FILE), help='state db file (default: %(default)s)')
+    group = parser.add_mutually_exclusive_group()
+    group.add_argument('--stuck', metavar='STAGE', help='list sheets which started STAGE but never finished it')
+    group.add_argument('--done', metavar='STAGE', help='list sheets which finished STAGE')
+    args = parser.parse_args()
+
+    if not Path(args.db).exists():
+        print(f'{args.db} does not exist')
+        sys.exit(1)
+
+    state = SheetState(args.db)
+    if args.stuck is not None:
+        for sheet_id in state.get_sheets(args.stuck, 'running'):
+            print(sheet_id)
+    elif args.done is not None:
+        for sheet_id in state.get_sheets(args.done, 'done'):
+            print(sheet_id)
+    else:
+        for stage, status, count, duration, size in state.get_summary():
+            print(f'{stage:>12} {status:>8} {count:>8} sheets {duration or 0:>12.1f} secs {size or 0:>16} bytes')
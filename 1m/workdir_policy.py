@@ -0,0 +1,73 @@
+import os
+import shutil
+from pathlib import Path
+
+KEEP_ALL = 'keep-all'
+KEEP_FINAL = 'keep-final'
+KEEP_NONE_AFTER_EXPORT = 'keep-none-after-export'
+
+RETENTION_POLICIES = [KEEP_ALL, KEEP_FINAL, KEEP_NONE_AFTER_EXPORT]
+
+# all that export() reads from the workdir, everything else is done with once final.tif is recorded
+EXPORT_INPUTS = ['final.tif', 'cutline.geojson']
+
+DEFAULT_INTER_DIR = Path('data/inter')
+EXPORT_DIR = Path('export')
+
+
+def get_retention_policy():
+    policy = os.getenv('WORKDIR_RETENTION', KEEP_NONE_AFTER_EXPORT)
+    if policy not in RETENTION_POLICIES:
+        raise ValueError(f'unknown workdir retention policy {policy}, expected one of {RETENTION_POLICIES}')
+    return policy
+
+
+def get_inter_dir_override():
+    # lets the per sheet workdirs live somewhere else, like a tmpfs
+    inter_dir = os.getenv('INTER_DIR', None)
+    if inter_dir is None or inter_dir == '':
+        return None
+    return Path(inter_dir)
+
+
+def get_watched_dirs():
+    # where the intermediates and the outputs get written, for the disk budget
+    return [get_inter_dir_override() or DEFAULT_INTER_DIR, EXPORT_DIR]
+
+
+def get_size(path):
+    if path.is_dir():
+        return sum(p.stat().st_size for p in path.rglob('*') if p.is_file())
+    return path.stat().st_size
+
+
+def prune_workdir(workdir, keep):
+    if not workdir.exists():
+        return 0
+    freed = 0
+    for p in workdir.iterdir():
+        if p.name in keep:
+            continue
+        freed += get_size(p)
+        if p.is_dir():
+            shutil.rmtree(p, ignore_errors=True)
+        else:
+            p.unlink(missing_ok=True)
+    return freed
+
+
+def cleanup_after_warp(workdir, policy):
+    if policy == KEEP_ALL:
+        return
+    freed = prune_workdir(workdir, EXPORT_INPUTS)
+    if freed > 0:
+        print(f'removed {freed / (1024 * 1024):.1f} MB of intermediates from {workdir}')
+
+
+def cleanup_after_export(workdir, policy):
+    if policy == KEEP_ALL:
+        return
+    if policy == KEEP_FINAL:
+        prune_workdir(workdir, EXPORT_INPUTS)
+        return
+    shutil.rmtree(workdir, ignore_errors=True)
@@ -13,18 +13,28 @@
 
 
 import os
+import time
 import math
 import json
+import argparse
 import traceback
 from pathlib import Path
+from functools import partial
 
+import numpy as np
 from PIL import Image
-from pyproj import Transformer, CRS
 from geojson_rewind import rewind
 
 from topo_map_processor.processor import TopoMapProcessor
 
-from ozi_map import ozi_reader
+from sheet_runner import run_sheets, DiskBudget
+from failure_log import FailureLog, get_failure_record
+from sheet_state import get_sheet_state, get_input_hash, get_params_hash
+from gdal_backend import run_in_process, get_gdal
+from map_index import get_map_data, update_map_index
+from workdir_policy import RETENTION_POLICIES, KEEP_NONE_AFTER_EXPORT, get_retention_policy, get_inter_dir_override, get_watched_dirs, cleanup_after_warp, cleanup_after_export
+from image_probe import update_image_manifest, get_image_info
+from crs_registry import get_transformer, get_geodetic_transformer, coords_to_pixels, project_gcps, pixels_to_coords, transform_points, get_stats_str
 
 def get_pulkovo1942_gk_epsg(zone_number):
     """
@@ -80,6 +90,18 @@ class GSMapstorProcessor(TopoMapProcessor):
 
     def __init__(self, filepath, extra, index_box, index_properties, id_override=None):
         super().__init__(filepath, extra, index_box, index_properties)
+        self.running_cmd = None
+        self.sheet_state = None
+        self.input_hash = None
+        self.redo_stages = False
+        # run the gdal commands through the osgeo.gdal api instead of shelling out
+        self.gdal_in_process = os.getenv('GDAL_IN_PROCESS', '0') == '1'
+        # georeference straight from the source gif/jpg instead of a q100 full.jpg re-encode
+        self.direct_source = os.getenv('DIRECT_SOURCE', '0') == '1' and not self.inset_pixel_cutlines
+        # how much of the workdir is left behind after the warp and the export
+        self.retention = get_retention_policy()
+        # chain georeference -> first_warp -> warp through vrts and only write out final.tif
+        self.use_vrt_chain = os.getenv('VRT_CHAIN', '0') == '1'
         self.id_override = id_override
         self.mapfile_processed = False
         self.mapfile_title = None
@@ -100,6 +122,106 @@ class GSMapstorProcessor(TopoMapProcessor):
             return self.id_override
         return super().get_id()
 
+    def get_inter_dir(self):
+        inter_dir = get_inter_dir_override()
+        if inter_dir is not None:
+            return inter_dir
+        return super().get_inter_dir()
+
+    def run_external(self, cmd):
+        # when running in a worker pool, only use this worker's share of the cores
+        worker_threads = os.environ.get('GDAL_WORKER_THREADS', None)
+        if worker_threads is not None:
+            cmd = cmd.replace('ALL_CPUS', worker_threads)
+        # remembered for the failure log
+        self.running_cmd = cmd
+        if self.gdal_in_process:
+            run_in_process(cmd)
+        else:
+            super().run_external(cmd)
+        self.running_cmd = None
+
+    def is_stage_done(self, stage, output_file):
+        if self.redo_stages:
+            return False
+        return self.sheet_state.is_done(self.get_id(), stage, self.input_hash, output_file)
+
+    def run_stage(self, stage, output_file, fn):
+        if self.sheet_state is None:
+            fn()
+            return
+
+        sheet_id = self.get_id()
+        if self.is_stage_done(stage, output_file):
+            print(f'{stage} already done for {sheet_id}.. skipping')
+            return
+
+        # anything on disk without a completion record is left over from an interrupted run
+        if output_file.exists():
+            print(f'{output_file} was not recorded as complete.. redoing {stage}')
+            output_file.unlink()
+
+        # everything downstream of a redone stage has to be redone as well
+        self.redo_stages = True
+
+        self.sheet_state.mark_started(sheet_id, stage, self.input_hash)
+        start = time.time()
+        fn()
+        end = time.time()
+        self.sheet_state.mark_done(sheet_id, stage, self.input_hash, output_file, end - start)
+
+    def process(self):
+        if self.sheet_state is None:
+            return super().process()
+
+        sheet_id = self.get_id()
+        export_file = self.get_export_file()
+        if export_file.exists() and not self.sheet_state.has_sheet(sheet_id):
+            # exported before the state db existed
+            self.sheet_state.mark_done(sheet_id, 'export', self.input_hash, export_file, None)
+            return True
+
+        workdir = self.get_workdir()
+        final_file = workdir.joinpath('final.tif')
+
+        # the earlier stages are only needed to get to final.tif, and their outputs may have been cleaned up already
+        if not self.is_stage_done('warp', final_file):
+            # georeference() skips if there is a final.tif around
+            if final_file.exists():
+                final_file.unlink()
+
+            def rotate():
+                self.remove_insets()
+                self.rotate()
+
+            self.run_stage('rotate', self.get_converted_file(), rotate)
+
+            # pause to debug
+            self.prompt1()
+
+            self.run_stage('georeference', self.get_georef_file(), self.georeference)
+        self.run_stage('warp', final_file, self.warp)
+        cleanup_after_warp(workdir, self.retention)
+        self.run_stage('export', export_file, self.export)
+
+        # pause to debug
+        self.prompt2()
+
+        cleanup_after_export(workdir, self.retention)
+        return True
+
+    def get_georef_file(self):
+        workdir = self.get_workdir()
+        if self.use_vrt_chain:
+            return workdir.joinpath('georef.vrt')
+        return workdir.joinpath('georef.tif')
+
+    def get_warped_file(self):
+        workdir = self.get_workdir()
+        if self.use_vrt_chain:
+            return workdir.joinpath('warped.vrt')
+        return workdir.joinpath('warped.tif')
+
     #def get_resolution(self):
     #    return "auto"
 
@@ -153,11 +275,7 @@ class GSMapstorProcessor(TopoMapProcessor):
         if self.cutline_override is not None:
             gcps = self.get_gcps()
             transformer = self.get_transformer_from_gcps(gcps)
-            corners = []
-            for corner in self.cutline_override:
-                x, y = transformer.rowcol(corner[0], corner[1])
-                corners.append((x, y))
-            return corners[:-1]
+            return coords_to_pixels(transformer, self.cutline_override[:-1])
 
         if self.corner_gcps is not None:
             corners = []
@@ -172,8 +290,7 @@ class GSMapstorProcessor(TopoMapProcessor):
     def process_map_file(self):
         if self.mapfile_processed:
             return
-        map_filepath = self.filepath.with_suffix('.map')
-        map_data = ozi_reader.read_ozi_map(open(map_filepath, 'rb'))
+        map_data = get_map_data(self.filepath.with_suffix('.map'))
 
         self.index_properties['maptitle'] = map_data.get('title', '')
 
@@ -195,7 +312,7 @@ class GSMapstorProcessor(TopoMapProcessor):
 
         workdir = self.get_workdir()
 
-        full_img_path = workdir / 'full.jpg'
+        full_img_path = self.get_converted_file()
 
         if full_img_path.exists():
             return
@@ -203,9 +320,42 @@ class GSMapstorProcessor(TopoMapProcessor):
         self.ensure_dir(workdir)
 
         img = Image.open(self.filepath)
+
+        if self.direct_source:
+            # describe the rgb conversion in a vrt and let gdal read the source directly
+            if img.mode == 'P':
+                band_options = '-expand rgb'
+            elif img.mode == 'L':
+                band_options = '-b 1 -b 1 -b 1'
+            else:
+                band_options = '-b 1 -b 2 -b 3'
+            self.run_external(f'gdal_translate -of VRT {band_options} {str(self.filepath.resolve())} {str(full_img_path)}')
+            return
+
         rgb_img = img.convert('RGB')
         rgb_img.save(full_img_path, format='JPEG', subsampling=0, quality=100)
 
+    def get_converted_file(self):
+        workdir = self.get_workdir()
+        if self.direct_source:
+            return workdir / 'full.vrt'
+        return workdir / 'full.jpg'
+
+    def get_full_file_path(self):
+        converted_file = self.get_converted_file()
+        if self.direct_source and converted_file.exists():
+            return converted_file
+        return super().get_full_file_path()
+
+    def get_full_img(self):
+        if self.full_img is not None or not self.direct_source:
+            return super().get_full_img()
+
+        # opencv can't read the vrt, decode the source instead
+        img = Image.open(self.filepath).convert('RGB')
+        self.full_img = np.array(img)[:, :, ::-1]
+        return self.full_img
+
 
     def export_bounds_file(self):
         bounds_dir = self.get_bounds_dir()
@@ -240,23 +390,43 @@ class GSMapstorProcessor(TopoMapProcessor):
 
 
 
+    def get_full_img_size(self):
+        # only the image header is read, the pixels are not decoded
+        if self.direct_source:
+            info = get_image_info(self.filepath)
+            if 'width' in info:
+                return info['width'], info['height']
+        full_file = self.filepath if self.direct_source else self.get_full_file_path()
+        with Image.open(full_file) as img:
+            return img.size
+
     def get_same_proj_resolution(self):
         gcps = self.get_gcps()
+        crs_proj = self.get_crs_proj_real()
+        w, h = self.get_full_img_size()
 
-        #crs = CRS.from_proj4(self.get_crs_proj())
-        crs = CRS.from_proj4(self.get_crs_proj_real())
-        geog_crs = crs.geodetic_crs
-        transformer = Transformer.from_crs(geog_crs, crs, always_xy=True)
-        projected_gcps = []
-        for gcp in gcps:
-            corner = gcp[0]
-            idx    = gcp[1]
-            projected_idx = transformer.transform(idx[0], idx[1])
-            projected_gcps.append((corner, projected_idx))
+        if self.sheet_state is None:
+            return self.solve_same_proj_resolution(gcps, crs_proj, w, h)
+
+        # recorded against the source image, so the reruns and the parts of a sheet
+        # which end up with the same zone and gcps reuse it
+        source_id = self.filepath.stem
+        params_hash = get_params_hash(crs_proj, gcps, w, h)
+        res = self.sheet_state.get_value(source_id, 'same_proj_resolution', params_hash)
+        if res is not None:
+            print(f'using recorded same proj resolution {res}')
+            return tuple(res)
+
+        res = self.solve_same_proj_resolution(gcps, crs_proj, w, h)
+        if res[0].imag == 0 and res[1].imag == 0:
+            self.sheet_state.set_value(source_id, 'same_proj_resolution', params_hash, list(res))
+        return res
+
+    def solve_same_proj_resolution(self, gcps, crs_proj, w, h):
+        transformer = get_geodetic_transformer(crs_proj)
+        projected_gcps = project_gcps(transformer, gcps)
 
         proj_transformer = self.get_transformer_from_gcps(projected_gcps)
-        full_img = self.get_full_img()
-        h, w = full_img.shape[:2]
         corners = [
             (0, 0),
             (w, 0),
@@ -264,7 +434,7 @@ class GSMapstorProcessor(TopoMapProcessor):
             (0, h)
         ]
         #pprint(corners)
-        projected_corners = [proj_transformer.xy(corner[1], corner[0]) for corner in corners]
+        projected_corners = pixels_to_coords(proj_transformer, corners)
         #pprint(projected_corners)
 
         proj_ul = projected_corners[0]
@@ -327,7 +497,7 @@ class GSMapstorProcessor(TopoMapProcessor):
     def georeference(self):
         workdir = self.get_workdir()
 
-        georef_file = workdir.joinpath('georef.tif')
+        georef_file = self.get_georef_file()
         final_file  = workdir.joinpath('final.tif')
         if georef_file.exists() or final_file.exists():
             print(f'{georef_file} or {final_file} exists.. skipping')
@@ -339,25 +509,14 @@ class GSMapstorProcessor(TopoMapProcessor):
 
         if self.no_first_warp:
             #from_crs_proj = self.get_crs_proj()
-            from_crs = CRS.from_epsg('4284')
-
-            target_crs = CRS.from_epsg('4326')
-            transformer = Transformer.from_crs(from_crs, target_crs, always_xy=True)
+            transformer = get_transformer('EPSG:4284', 'EPSG:4326')
             crs_proj = 'EPSG:4326'
         else:
             crs_proj = self.get_crs_proj_real()
 
-            #crs = CRS.from_proj4(self.get_crs_proj())
-            crs = CRS.from_proj4(crs_proj)
-            geog_crs = crs.geodetic_crs
-            transformer = Transformer.from_crs(geog_crs, crs, always_xy=True)
+            transformer = get_geodetic_transformer(crs_proj)
 
-        projected_gcps = []
-        for gcp in gcps:
-            corner = gcp[0]
-            idx    = gcp[1]
-            projected_idx = transformer.transform(idx[0], idx[1])
-            projected_gcps.append((corner, projected_idx))
+        projected_gcps = project_gcps(transformer, gcps)
         gcps = projected_gcps
 
 
@@ -370,19 +529,24 @@ class GSMapstorProcessor(TopoMapProcessor):
         
         creation_options = '-co TILED=YES -co COMPRESS=DEFLATE -co PREDICTOR=2' 
         perf_options = '--config GDAL_CACHEMAX 128 --config GDAL_NUM_THREADS ALL_CPUS'
+        output_format = 'GTiff'
+        if self.use_vrt_chain:
+            # only attach the gcps, pixels are read from the source when the warps run
+            creation_options = ''
+            output_format = 'VRT'
 
         self.ensure_dir(workdir)
-        translate_cmd = f'gdal_translate {creation_options} {perf_options} {gcp_str} -a_srs "{crs_proj}" -of GTiff {str(from_file)} {str(georef_file)}' 
+        translate_cmd = f'gdal_translate {creation_options} {perf_options} {gcp_str} -a_srs "{crs_proj}" -of {output_format} {str(from_file)} {str(georef_file)}' 
         self.run_external(translate_cmd)
 
     def first_warp(self):
         workdir = self.get_workdir()
-        warped_file = workdir.joinpath('warped.tif')
+        warped_file = self.get_warped_file()
         if warped_file.exists():
             print(f'{warped_file} exists.. skipping')
             return
 
-        georef_file = workdir.joinpath('georef.tif')
+        georef_file = self.get_georef_file()
 
         self.ensure_dir(workdir)
         img_quality_config = {
@@ -417,6 +581,9 @@ class GSMapstorProcessor(TopoMapProcessor):
         #nodata_options = '-dstnodata 0'
         nodata_options = '-dstalpha'
         perf_options = '-multi -wo NUM_THREADS=ALL_CPUS --config GDAL_CACHEMAX 1024 -wm 1024' 
+        if self.use_vrt_chain:
+            # the tps warp is evaluated on the fly when the final warp reads from it
+            warp_quality_options = '-of VRT'
 
         warp_cmd = f'gdalwarp -overwrite {perf_options} {nodata_options} {reproj_options} {warp_quality_options} {str(georef_file)} {str(warped_file)}'
         self.run_external(warp_cmd)
@@ -431,11 +598,11 @@ class GSMapstorProcessor(TopoMapProcessor):
             return
 
         if self.no_first_warp:
-            inp_file = workdir.joinpath('georef.tif')
+            inp_file = self.get_georef_file()
             inp_crs_proj = 'EPSG:4326'
         else:
-            self.first_warp()
-            inp_file = workdir.joinpath('warped.tif')
+            self.run_stage('first_warp', self.get_warped_file(), self.first_warp)
+            inp_file = self.get_warped_file()
             inp_crs_proj = self.get_crs_proj_real()
 
         cutline_file = workdir.joinpath('cutline.geojson')
@@ -443,8 +610,8 @@ class GSMapstorProcessor(TopoMapProcessor):
         sheet_ibox = self.get_updated_sheet_ibox()
         if self.no_first_warp:
             cutline_crs_proj = 'EPSG:4326'
-            transformer = Transformer.from_crs(CRS.from_epsg(4284), CRS.from_epsg(4326), always_xy=True)
-            sheet_ibox = [ transformer.transform(p[0], p[1]) for p in sheet_ibox ]
+            transformer = get_transformer('EPSG:4284', 'EPSG:4326')
+            sheet_ibox = transform_points(transformer, sheet_ibox)
         else:
             cutline_crs_proj = 'EPSG:4284'
 
@@ -500,7 +667,59 @@ def get_bad_sheet_ids():
         bad_sheet_ids = [ line.strip() for line in f.readlines() if line.strip() != '' ]
     return bad_sheet_ids
 
-def process_files():
+def get_sheet_tasks(image_files, special_cases, sheet_map, bad_sheet_ids):
+    tasks = []
+    for filepath in image_files:
+        extra = special_cases.get(filepath.name, {})
+        id = filepath.name.replace('.gif', '')
+        if '_' not in id:
+            print(f'Skipping {filepath} due to hyphen in id')
+            continue
+        if id in bad_sheet_ids:
+            continue
+        sheet_props = sheet_map[id]
+        sheet_props['source_type'] = 'mapstor'
+
+        subs = []
+        if 'parts' not in extra:
+            subs.append([id, extra])
+        else:
+            for i, part in enumerate(extra['parts']):
+                subs.append([f'{id}-part{i}', part])
+
+        for subid, subextra in subs:
+            tasks.append((filepath, subid, subextra, sheet_props))
+    return tasks
+
+def process_sheet(task, interactive=True):
+    filepath, subid, subextra, sheet_props = task
+
+    sheet_state = get_sheet_state()
+    input_hash = get_input_hash(filepath, subextra)
+    processor = GSMapstorProcessor(filepath, subextra, [], sheet_props, id_override=subid)
+    # the export has to still be there and of the recorded size, deleting it is how a sheet gets redone
+    if sheet_state.is_done(subid, 'export', input_hash, processor.get_export_file()):
+        return subid, True, None
+
+    processor.sheet_state = sheet_state
+    processor.input_hash = input_hash
+
+    try:
+        processor.process()
+
+        #filepath.unlink()
+        #filepath.with_suffix('.map').unlink()
+        return subid, True, None
+    except Exception as ex:
+        print(f'parsing {filepath} failed with exception: {ex}')
+        traceback.print_exc()
+        failure = get_failure_record(subid, filepath, ex, processor.running_cmd)
+        if interactive:
+            #raise
+            processor.prompt()
+        return subid, False, failure
+
+def process_files(workers=1, batch=False, retry_failed=False, skip_bad_images=False, min_free_gb=None):
     
     data_dir = Path('mapstor/data/raw')
     
@@ -525,51 +744,60 @@ def process_files():
 
     bad_sheet_ids = get_bad_sheet_ids()
 
-    total = len(image_files)
-    processed_count = 0
-    failed_count = 0
-    success_count = 0
-    # Process each file
-    for filepath in image_files:
-        print(f'==========  Processed: {processed_count}/{total} Success: {success_count} Failed: {failed_count} processing {filepath.name} ==========')
-        extra = special_cases.get(filepath.name, {})
-        id = filepath.name.replace('.gif', '')
-        if '_' not in id:
-            print(f'Skipping {filepath} due to hyphen in id')
-            continue
-        if id in bad_sheet_ids:
-            continue
-        sheet_props = sheet_map[id]
-        sheet_props['source_type'] = 'mapstor'
+    # parse all the .map files once up front instead of in every processor
+    update_map_index(data_dir)
 
-        subs = []
-        if 'parts' not in extra:
-            subs.append([id, extra])
-        else:
-            for i, part in enumerate(extra['parts']):
-                subs.append([f'{id}-part{i}', part])
+    # truncated downloads are flagged here, instead of failing in the middle of a warp
+    bad_images = update_image_manifest(data_dir).get_bad(image_files)
+    if bad_images:
+        print(f'{len(bad_images)} truncated or unreadable images, see `python image_probe.py {data_dir}`: {" ".join(sorted(bad_images))}')
+        if skip_bad_images:
+            image_files = [ f for f in image_files if f.name not in bad_images ]
 
-        for subid, subextra in subs:
-            try:
-                processor = GSMapstorProcessor(filepath, subextra, [], sheet_props, id_override=subid)
-                processor.process()
+    tasks = get_sheet_tasks(image_files, special_cases, sheet_map, bad_sheet_ids)
 
-                #filepath.unlink()
-                #filepath.with_suffix('.map').unlink()
-                success_count += 1
-            except Exception as ex:
-                print(f'parsing {filepath} failed with exception: {ex}')
-                failed_count += 1
-                traceback.print_exc()
-                #raise
-                processor.prompt()
-            processed_count += 1
+    failure_log = FailureLog(data_dir.parent / 'failures.jsonl')
+    if retry_failed:
+        failed_ids = failure_log.get_failed_ids()
+        tasks = [ task for task in tasks if task[1] in failed_ids ]
+        print(f'retrying {len(tasks)} failed sheets')
 
-    print(f"Processed {processed_count} images, failed_count {failed_count}, success_count {success_count}")
+    interactive = not batch and workers <= 1
+    disk_budget = None
+    if min_free_gb is not None:
+        disk_budget = DiskBudget(get_watched_dirs(), min_free_gb * 1024 ** 3)
+    run_sheets(tasks, partial(process_sheet, interactive=interactive), workers=workers, failure_log=failure_log, disk_budget=disk_budget)
+    if workers <= 1:
+        print(get_stats_str())
 
 
 if __name__ == "__main__":
     import os
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--workers', type=int, default=1, help='number of sheets to process in parallel')
+    parser.add_argument('--batch', action='store_true', help='record failures in the failure log and keep going instead of stopping')
+    parser.add_argument('--retry-failed', action='store_true', help='only process the sheets in the failure log')
+    parser.add_argument('--skip-bad-images', action='store_true', help='leave out the images which the header probe finds truncated or unreadable')
+    parser.add_argument('--vrt-chain', action='store_true', help='keep georef and warped as vrts and only write out the final warp')
+    parser.add_argument('--gdal-in-process', action='store_true', help='run gdal through its python api instead of the command line tools, needs the gdal bindings of the installed gdal, like `uv run --with gdal==$(gdal-config --version)`')
+    parser.add_argument('--direct-source', action='store_true', help='read the source image through a vrt instead of converting it to full.jpg')
+    parser.add_argument('--retention', choices=RETENTION_POLICIES, default=KEEP_NONE_AFTER_EXPORT, help='what to keep of the per sheet workdirs, keep-final keeps just what export needs once the warp is done (default: %(default)s)')
+    parser.add_argument('--min-free-gb', type=float, default=None, help='hold back new sheets while the free space for the workdirs or the exports is below this')
+    parser.add_argument('--inter-dir', default=None, help='put the per sheet workdirs here instead of data/inter, like on a tmpfs')
+    args = parser.parse_args()
+    if args.direct_source:
+        os.environ['DIRECT_SOURCE'] = '1'
+    if args.gdal_in_process:
+        os.environ['GDAL_IN_PROCESS'] = '1'
+    if os.getenv('GDAL_IN_PROCESS', '0') == '1':
+        try:
+            get_gdal()
+        except ImportError as ex:
+            parser.error(str(ex))
+    if args.vrt_chain:
+        os.environ['VRT_CHAIN'] = '1'
+    os.environ['WORKDIR_RETENTION'] = args.retention
+    if args.inter_dir is not None:
+        os.environ['INTER_DIR'] = args.inter_dir
     os.environ['GDAL_PAM_ENABLED'] = 'NO'
-    process_files()
- 
+    process_files(workers=args.workers, batch=args.batch, retry_failed=args.retry_failed, skip_bad_images=args.skip_bad_images, min_free_gb=args.min_free_gb)
@@ -2,6 +2,7 @@
 # /// script
 # requires-python = ">=3.12"
 # dependencies = [
+#     "numpy",
 #     "pyproj",
 #     "shapely",
 #     "ozi-map",
@@ -13,16 +14,17 @@
 
 import json
 from pathlib import Path
-from pyproj import Transformer
 from shapely.geometry import Polygon, MultiPolygon, LineString, mapping
 from shapely.ops import split
-import ozi_map.ozi_reader as ozi_reader
 import sys
 
+from map_index import update_map_index, get_map_data
+from crs_registry import get_transformer, transform_points
+
 base_dir = Path('mapstor/data/raw')
 def get_cutline_from_map_file(map_file_path):
     try:
-        map_data = ozi_reader.read_ozi_map(open(map_file_path, 'rb'))
+        map_data = get_map_data(map_file_path)
         return map_data.get('cutline')
     except Exception as e:
         print(f"Error reading map file {map_file_path}: {e}", file=sys.stderr)
@@ -31,8 +33,8 @@ def get_cutline_from_map_file(map_file_path):
 def process_antimeridian(gif_files):
     output_data = {}
 
-    transformer_to_4326 = Transformer.from_crs("EPSG:4284", "EPSG:4326", always_xy=True)
-    transformer_to_4284 = Transformer.from_crs("EPSG:4326", "EPSG:4284", always_xy=True)
+    transformer_to_4326 = get_transformer('EPSG:4284', 'EPSG:4326')
+    transformer_to_4284 = get_transformer('EPSG:4326', 'EPSG:4284')
 
     antimeridian_splitter = LineString([(180, -90), (180, 90)])
 
@@ -50,7 +52,7 @@ def process_antimeridian(gif_files):
         if not cutline_4284:
             continue
 
-        cutline_4326 = [transformer_to_4326.transform(lon, lat) for lon, lat in cutline_4284]
+        cutline_4326 = transform_points(transformer_to_4326, cutline_4284)
 
         # Normalize longitudes to [0, 360] to handle antimeridian crossing
         cutline_360 = []
@@ -97,7 +99,7 @@ def process_antimeridian(gif_files):
             reordered_coords.append(reordered_coords[0]) # close polygon
 
             # Transform back to EPSG:4284
-            cutline_4284_part = [transformer_to_4284.transform(lon, lat) for lon, lat in reordered_coords]
+            cutline_4284_part = transform_points(transformer_to_4284, reordered_coords)
             cutline_4284_part = [[round(lon, 7), round(lat, 7)] for lon, lat in cutline_4284_part]
             parts.append({"cutline_override": cutline_4284_part})
         
@@ -114,6 +116,8 @@ def main():
     with open(gif_list_file, 'r') as f:
         gif_files = f.read().splitlines()
 
+    update_map_index(base_dir)
+
     result = process_antimeridian(gif_files)
     print(json.dumps(result, indent=2))
 
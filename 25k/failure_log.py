@@ -0,0 +1,67 @@
+import json
+import traceback
+from pathlib import Path
+
+# processor methods, in the order they are called, used to figure out where a sheet failed
+STAGES = [
+    'process_map_file',
+    'remove_insets',
+    'rotate',
+    'georeference',
+    'first_warp',
+    'warp',
+    'export_bounds_file',
+    'export_gtiff',
+    'add_digest_to_bounds_file',
+]
+
+
+def get_failed_stage(ex):
+    stage = None
+    for frame in traceback.extract_tb(ex.__traceback__):
+        if frame.name in STAGES:
+            stage = frame.name
+    return stage
+
+
+def get_failure_record(sheet_id, filepath, ex, cmd=None):
+    return {
+        'id': sheet_id,
+        'file': str(filepath),
+        'stage': get_failed_stage(ex),
+        'exception': f'{type(ex).__name__}: {ex}',
+        'traceback': ''.join(traceback.format_exception(ex)),
+        'cmd': cmd,
+    }
+
+
+class FailureLog:
+    def __init__(self, log_file):
+        self.log_file = Path(log_file)
+        self.failures = {}
+        if self.log_file.exists():
+            for line in self.log_file.read_text().split('\n'):
+                if line.strip() == '':
+                    continue
+                record = json.loads(line)
+                self.failures[record['id']] = record
+
+    def get_failed_ids(self):
+        return set(self.failures.keys())
+
+    def record_failure(self, record):
+        self.failures[record['id']] = record
+        # append as we go, so that a killed run still leaves the failures behind
+        self.log_file.parent.mkdir(parents=True, exist_ok=True)
+        with open(self.log_file, 'a') as f:
+            f.write(json.dumps(record) + '\n')
+
+    def record_success(self, sheet_id):
+        self.failures.pop(sheet_id, None)
+
+    def save(self):
+        self.log_file.parent.mkdir(parents=True, exist_ok=True)
+        with open(self.log_file, 'w') as f:
+            for record in self.failures.values():
+                f.write(json.dumps(record) + '\n')
+        print(f'{len(self.failures)} failures recorded in {self.log_file}')
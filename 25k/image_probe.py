@@ -0,0 +1,316 @@
+import os
+import sys
+import mmap
+import json
+import struct
+import argparse
+from pathlib import Path
+
+MANIFEST_FILE_NAME = 'image_probe.jsonl'
+
+EXTENSIONS = ('.gif', '.jpg', '.jpeg')
+
+# a truncated download is missing the end of stream marker, which is only looked for this close to the end,
+# some jpgs carry a few bytes of padding after it
+TAIL_SIZE = 1024
+
+JPEG_SOF_MARKERS = set([0xc0, 0xc1, 0xc2, 0xc3, 0xc5, 0xc6, 0xc7, 0xc9, 0xca, 0xcb, 0xcd, 0xce, 0xcf])
+JPEG_STANDALONE_MARKERS = set([0x01, 0xd8] + list(range(0xd0, 0xd8)))
+
+_manifests = {}
+
+
+def skip_gif_sub_blocks(f):
+    while True:
+        size = f.read(1)
+        if not size:
+            return False
+        if size[0] == 0:
+            return True
+        f.seek(size[0], os.SEEK_CUR)
+
+
+def walk_gif(f, file_size):
+    # walks the block structure up to the trailer, the image data is skipped over and never decompressed
+    frames = 0
+    while True:
+        introducer = f.read(1)
+        if not introducer:
+            return frames, False
+        if introducer == b'\x3b':
+            return frames, True
+        if introducer == b'\x21':
+            if not f.read(1) or not skip_gif_sub_blocks(f):
+                return frames, False
+        elif introducer == b'\x2c':
+            descriptor = f.read(9)
+            if len(descriptor) != 9:
+                return frames, False
+            packed = descriptor[8]
+            if packed & 0x80:
+                f.seek(3 * (2 << (packed & 0x07)), os.SEEK_CUR)
+            # lzw minimum code size
+            if not f.read(1) or not skip_gif_sub_blocks(f):
+                return frames, False
+            frames += 1
+        else:
+            raise ValueError(f'unexpected gif block 0x{introducer[0]:02x} at {f.tell() - 1}')
+        if f.tell() > file_size:
+            return frames, False
+
+
+def probe_gif(f, file_size, deep):
+    header = f.read(13)
+    if len(header) != 13:
+        return { 'truncated': True }
+    width, height, packed = struct.unpack('<HHB', header[6:11])
+    info = {
+        'width': width,
+        'height': height,
+        'palette_size': (2 << (packed & 0x07)) if packed & 0x80 else None,
+    }
+    if not deep:
+        f.seek(file_size - 1)
+        info['truncated'] = f.read(1) != b'\x3b'
+        return info
+
+    if packed & 0x80:
+        f.seek(3 * info['palette_size'], os.SEEK_CUR)
+    frames, complete = walk_gif(f, file_size)
+    info['frames'] = frames
+    info['truncated'] = not complete or frames == 0
+    return info
+
+
+def find_jpeg_marker(mm, pos):
+    # skips over entropy coded data, stuffed 0xff00 bytes and restart markers
+    while True:
+        pos = mm.find(b'\xff', pos)
+        if pos < 0 or pos + 1 >= len(mm):
+            return None
+        marker = mm[pos + 1]
+        if marker == 0xff:
+            pos += 1
+        elif marker == 0x00 or 0xd0 <= marker <= 0xd7:
+            pos += 2
+        else:
+            return pos
+
+
+def walk_jpeg(mm, pos):
+    # follows the segments and the scans in between them up to the end of image marker
+    while True:
+        pos = find_jpeg_marker(mm, pos)
+        if pos is None:
+            return False
+        marker = mm[pos + 1]
+        if marker == 0xd9:
+            return True
+        if marker in JPEG_STANDALONE_MARKERS:
+            pos += 2
+            continue
+        if pos + 4 > len(mm):
+            return False
+        length = struct.unpack('>H', mm[pos + 2:pos + 4])[0]
+        pos += 2 + length
+
+
+def read_jpeg_marker(f):
+    b = f.read(1)
+    if not b:
+        return None
+    if b != b'\xff':
+        raise ValueError(f'bad jpeg marker at {f.tell() - 1}')
+    # any number of 0xff fill bytes can precede a marker
+    while b == b'\xff':
+        b = f.read(1)
+    if not b:
+        return None
+    return b[0]
+
+
+def probe_jpeg(f, file_size, deep):
+    if f.read(2) != b'\xff\xd8':
+        raise ValueError('missing jpeg start of image marker')
+    info = None
+    while info is None:
+        marker = read_jpeg_marker(f)
+        if marker is None:
+            return { 'truncated': True }
+        if marker in JPEG_STANDALONE_MARKERS:
+            continue
+        if marker == 0xd9:
+            raise ValueError('jpeg ends before its frame header')
+        segment_start = f.tell()
+        length_bytes = f.read(2)
+        if len(length_bytes) != 2:
+            return { 'truncated': True }
+        length = struct.unpack('>H', length_bytes)[0]
+        if marker in JPEG_SOF_MARKERS:
+            segment = f.read(6)
+            if len(segment) != 6:
+                return { 'truncated': True }
+            _, height, width, components = struct.unpack('>BHHB', segment)
+            info = {
+                'width': width,
+                'height': height,
+                'components': components,
+                'progressive': marker in (0xc2, 0xc6, 0xca, 0xce),
+            }
+        f.seek(segment_start + length)
+
+    if not deep:
+        tail_start = max(f.tell(), file_size - TAIL_SIZE)
+        f.seek(tail_start)
+        info['truncated'] = b'\xff\xd9' not in f.read()
+        return info
+
+    with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+        info['truncated'] = not walk_jpeg(mm, f.tell())
+    return info
+
+
+def probe_image(filepath, deep=False):
+    """
+    Reads the dimensions and the palette from the image header and checks for the end of stream marker.
+    With deep set, the block structure of the whole file is walked, which also catches corruption in
+    the middle of the file, but none of the pixel data is ever decoded.
+    """
+    filepath = Path(filepath)
+    file_size = filepath.stat().st_size
+    with open(filepath, 'rb') as f:
+        signature = f.read(6)
+        f.seek(0)
+        if signature in (b'GIF87a', b'GIF89a'):
+            info = { 'format': 'gif' }
+            info.update(probe_gif(f, file_size, deep))
+        elif signature[:2] == b'\xff\xd8':
+            info = { 'format': 'jpeg' }
+            info.update(probe_jpeg(f, file_size, deep))
+        else:
+            raise ValueError(f'unknown image format, starts with {signature!r}')
+    return info
+
+
+def get_image_manifest(image_dir):
+    image_dir = Path(image_dir)
+    key = str(image_dir.resolve())
+    if key not in _manifests:
+        _manifests[key] = ImageManifest(image_dir)
+    return _manifests[key]
+
+
+def get_image_info(filepath):
+    filepath = Path(filepath)
+    return get_image_manifest(filepath.parent).get(filepath)
+
+
+def update_image_manifest(image_dir, deep=False):
+    manifest = get_image_manifest(image_dir)
+    manifest.update(deep=deep)
+    return manifest
+
+
+class ImageManifest:
+    """
+    Header probes of all the images of a directory in a single json lines file, kept next to them.
+    Entries are keyed by file name and invalidated by size and mtime, like the .map file index.
+    """
+    def __init__(self, image_dir):
+        self.image_dir = Path(image_dir)
+        self.manifest_file = self.image_dir / MANIFEST_FILE_NAME
+        self.entries = {}
+        if self.manifest_file.exists():
+            with open(self.manifest_file, 'r') as f:
+                for line in f:
+                    if line.strip() == '':
+                        continue
+                    entry = json.loads(line)
+                    self.entries[entry['name']] = entry
+
+    def is_fresh(self, entry, st, deep=False):
+        if deep and not entry['deep']:
+            return False
+        return entry['size'] == st.st_size and entry['mtime_ns'] == st.st_mtime_ns
+
+    def probe(self, name, st, deep=False):
+        entry = { 'name': name, 'size': st.st_size, 'mtime_ns': st.st_mtime_ns, 'deep': deep }
+        try:
+            entry.update(probe_image(self.image_dir / name, deep=deep))
+            entry['error'] = None
+        except Exception as ex:
+            entry['error'] = f'{type(ex).__name__}: {ex}'
+        return entry
+
+    def update(self, deep=False):
+        seen = set()
+        probed = 0
+        for dirent in os.scandir(self.image_dir):
+            if not dirent.name.lower().endswith(EXTENSIONS) or not dirent.is_file():
+                continue
+            seen.add(dirent.name)
+            st = dirent.stat()
+            entry = self.entries.get(dirent.name)
+            if entry is not None and self.is_fresh(entry, st, deep):
+                continue
+            self.entries[dirent.name] = self.probe(dirent.name, st, deep)
+            probed += 1
+
+        removed = set(self.entries.keys()) - seen
+        for name in removed:
+            del self.entries[name]
+
+        if probed > 0 or removed:
+            self.save()
+        return probed, len(removed)
+
+    def save(self):
+        tmp_file = self.manifest_file.with_suffix('.jsonl.tmp')
+        with open(tmp_file, 'w') as f:
+            for name in sorted(self.entries.keys()):
+                f.write(json.dumps(self.entries[name]) + '\n')
+        tmp_file.replace(self.manifest_file)
+
+    def get(self, filepath):
+        filepath = Path(filepath)
+        st = filepath.stat()
+        entry = self.entries.get(filepath.name)
+        if entry is None or not self.is_fresh(entry, st):
+            entry = self.probe(filepath.name, st)
+            self.entries[filepath.name] = entry
+        return entry
+
+    def is_bad(self, entry):
+        return entry['error'] is not None or entry['truncated']
+
+    def get_bad(self, filepaths=None):
+        # names of the images which are truncated or couldn't be probed at all
+        if filepaths is None:
+            names = self.entries.keys()
+        else:
+            names = [ Path(p).name for p in filepaths ]
+        return set(name for name in names if name in self.entries and self.is_bad(self.entries[name]))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='probe the image headers of a directory for size and truncation')
+    parser.add_argument('image_dir', nargs='+', help='directories containing .gif/.jpg files')
+    parser.add_argument('--deep', action='store_true', help='walk the block structure of every file instead of only checking the end of stream marker')
+    parser.add_argument('--bad', action='store_true', help='only print the names of the truncated or unreadable files')
+    args = parser.parse_args()
+
+    for image_dir in args.image_dir:
+        if not Path(image_dir).is_dir():
+            print(f'{image_dir} is not a directory')
+            sys.exit(1)
+        manifest = get_image_manifest(image_dir)
+        probed, removed = manifest.update(deep=args.deep)
+        bad = sorted(manifest.get_bad())
+        if args.bad:
+            for name in bad:
+                print(name)
+            continue
+        print(f'{manifest.manifest_file}: {len(manifest.entries)} entries, {probed} probed, {removed} removed, {len(bad)} bad')
+        for name in bad:
+            entry = manifest.entries[name]
+            print(f'{name}: {entry["error"] or "truncated"}')
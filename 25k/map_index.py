@@ -0,0 +1,128 @@
+import os
+import sys
+import json
+import argparse
+from pathlib import Path
+
+INDEX_FILE_NAME = 'map_index.jsonl'
+
+FIELDS = ['datum', 'gcps', 'cutline', 'cutline_pixels', 'title']
+
+_indexes = {}
+
+
+def parse_map_file(map_filepath):
+    # ozi_map is only needed when something has to be (re)parsed
+    from ozi_map import ozi_reader
+
+    with open(map_filepath, 'rb') as f:
+        map_data = ozi_reader.read_ozi_map(f)
+    return { k: map_data[k] for k in FIELDS if k in map_data }
+
+
+def get_map_index(map_dir):
+    # loaded once per process, forked workers inherit the index loaded by the parent
+    map_dir = Path(map_dir)
+    key = str(map_dir.resolve())
+    if key not in _indexes:
+        _indexes[key] = MapIndex(map_dir)
+    return _indexes[key]
+
+
+def get_map_data(map_filepath):
+    map_filepath = Path(map_filepath)
+    return get_map_index(map_filepath.parent).get(map_filepath)
+
+
+def update_map_index(map_dir):
+    index = get_map_index(map_dir)
+    index.update()
+    return index
+
+
+class MapIndex:
+    """
+    All the parsed .map files of a directory in a single json lines file, kept next to them.
+    Entries are keyed by file name and invalidated by size and mtime.
+    """
+    def __init__(self, map_dir):
+        self.map_dir = Path(map_dir)
+        self.index_file = self.map_dir / INDEX_FILE_NAME
+        self.entries = {}
+        if self.index_file.exists():
+            with open(self.index_file, 'r') as f:
+                for line in f:
+                    if line.strip() == '':
+                        continue
+                    entry = json.loads(line)
+                    self.entries[entry['name']] = entry
+
+    def is_fresh(self, entry, st):
+        return entry['size'] == st.st_size and entry['mtime_ns'] == st.st_mtime_ns
+
+    def parse(self, name, st):
+        entry = { 'name': name, 'size': st.st_size, 'mtime_ns': st.st_mtime_ns }
+        try:
+            entry.update(parse_map_file(self.map_dir / name))
+            entry['error'] = None
+        except Exception as ex:
+            entry['error'] = f'{type(ex).__name__}: {ex}'
+        return entry
+
+    def update(self):
+        seen = set()
+        parsed = 0
+        for dirent in os.scandir(self.map_dir):
+            if not dirent.name.endswith('.map') or not dirent.is_file():
+                continue
+            seen.add(dirent.name)
+            st = dirent.stat()
+            entry = self.entries.get(dirent.name)
+            if entry is not None and self.is_fresh(entry, st):
+                continue
+            self.entries[dirent.name] = self.parse(dirent.name, st)
+            parsed += 1
+
+        removed = set(self.entries.keys()) - seen
+        for name in removed:
+            del self.entries[name]
+
+        if parsed > 0 or removed:
+            self.save()
+        return parsed, len(removed)
+
+    def save(self):
+        tmp_file = self.index_file.with_suffix('.jsonl.tmp')
+        with open(tmp_file, 'w') as f:
+            for name in sorted(self.entries.keys()):
+                f.write(json.dumps(self.entries[name]) + '\n')
+        tmp_file.replace(self.index_file)
+
+    def get(self, map_filepath):
+        map_filepath = Path(map_filepath)
+        st = map_filepath.stat()
+        entry = self.entries.get(map_filepath.name)
+        if entry is None or not self.is_fresh(entry, st):
+            # not indexed yet or changed since, only kept in memory until the next update()
+            entry = self.parse(map_filepath.name, st)
+            self.entries[map_filepath.name] = entry
+        if entry['error'] is not None:
+            raise ValueError(f'unable to parse {map_filepath}: {entry["error"]}')
+        return entry
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='build or refresh the .map file index of a directory')
+    parser.add_argument('map_dir', nargs='+', help='directories containing .map files')
+    args = parser.parse_args()
+
+    for map_dir in args.map_dir:
+        if not Path(map_dir).is_dir():
+            print(f'{map_dir} is not a directory')
+            sys.exit(1)
+        index = get_map_index(map_dir)
+        parsed, removed = index.update()
+        print(f'{index.index_file}: {len(index.entries)} entries, {parsed} parsed, {removed} removed')
+        for name, entry in sorted(index.entries.items()):
+            if entry['error'] is not None:
+                print(f'{name}: {entry["error"]}')
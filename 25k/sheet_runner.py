@@ -0,0 +1,134 @@
+import os
+import time
+import queue
+import shutil
+from pathlib import Path
+from multiprocessing import Pool, cpu_count
+
+
+def get_threads_per_worker(workers):
+    # split the cores between the workers instead of every gdal call using ALL_CPUS
+    return max(1, cpu_count() // workers)
+
+
+def init_worker(num_threads):
+    # picked up by GSMapstorProcessor.run_external to replace ALL_CPUS in the gdal commands
+    os.environ['GDAL_WORKER_THREADS'] = str(num_threads)
+    os.environ['GDAL_NUM_THREADS'] = str(num_threads)
+
+
+class SheetCounts:
+    def __init__(self, total, failure_log=None):
+        self.total = total
+        self.failure_log = failure_log
+        self.processed = 0
+        self.success = 0
+        self.failed = 0
+
+    def record(self, sheet_id, success, failure):
+        self.processed += 1
+        if success:
+            self.success += 1
+            if self.failure_log is not None:
+                self.failure_log.record_success(sheet_id)
+        else:
+            self.failed += 1
+            if self.failure_log is not None and failure is not None:
+                self.failure_log.record_failure(failure)
+        print(f'==========  Processed: {self.processed}/{self.total} Success: {self.success} Failed: {self.failed} done with {sheet_id} ==========')
+
+
+class DiskBudget:
+    """
+    Holds back new sheets while the free space on any of the watched dirs is below min_free bytes.
+    """
+    def __init__(self, dirs, min_free, poll_secs=30):
+        self.dirs = [ Path(d) for d in dirs ]
+        self.min_free = min_free
+        self.poll_secs = poll_secs
+        self.pauses = 0
+
+    def get_free(self):
+        free = []
+        for d in self.dirs:
+            # the dirs may not have been created yet
+            d = d.resolve()
+            while not d.exists():
+                d = d.parent
+            free.append(shutil.disk_usage(d).free)
+        return min(free)
+
+    def has_room(self):
+        return self.get_free() >= self.min_free
+
+    def wait_for_room(self):
+        # with nothing running that could free up space, it has to be freed by hand
+        if self.has_room():
+            return
+        self.pauses += 1
+        print(f'free space is below {self.min_free / (1024 ** 3):.1f} GB, pausing until some is freed')
+        while not self.has_room():
+            time.sleep(self.poll_secs)
+        print('resuming')
+
+
+def run_budgeted(pool, tasks, process_sheet, workers, disk_budget, counts):
+    # imap_unordered hands out all the tasks up front, so schedule them one at a time instead
+    results = queue.Queue()
+    next_task = 0
+    in_flight = 0
+    holding = False
+    while True:
+        while in_flight < workers and next_task < len(tasks):
+            if not disk_budget.has_room():
+                if in_flight > 0:
+                    # a running sheet will clean up its workdir when it is done
+                    if not holding:
+                        disk_budget.pauses += 1
+                        print(f'free space is below {disk_budget.min_free / (1024 ** 3):.1f} GB, holding back new sheets')
+                        holding = True
+                    break
+                disk_budget.wait_for_room()
+            holding = False
+            pool.apply_async(process_sheet, (tasks[next_task],), callback=results.put, error_callback=results.put)
+            next_task += 1
+            in_flight += 1
+
+        if in_flight == 0:
+            break
+
+        result = results.get()
+        in_flight -= 1
+        if isinstance(result, BaseException):
+            raise result
+        sheet_id, success, failure = result
+        counts.record(sheet_id, success, failure)
+
+
+def run_sheets(tasks, process_sheet, workers=1, failure_log=None, disk_budget=None):
+    counts = SheetCounts(len(tasks), failure_log)
+
+    try:
+        if workers <= 1:
+            for task in tasks:
+                if disk_budget is not None:
+                    disk_budget.wait_for_room()
+                sheet_id, success, failure = process_sheet(task)
+                counts.record(sheet_id, success, failure)
+        else:
+            num_threads = get_threads_per_worker(workers)
+            print(f'running {workers} workers with {num_threads} gdal threads each')
+            with Pool(workers, initializer=init_worker, initargs=(num_threads,)) as pool:
+                if disk_budget is not None:
+                    run_budgeted(pool, tasks, process_sheet, workers, disk_budget, counts)
+                else:
+                    for sheet_id, success, failure in pool.imap_unordered(process_sheet, tasks):
+                        counts.record(sheet_id, success, failure)
+    finally:
+        if failure_log is not None:
+            failure_log.save()
+
+    print(f"Processed {counts.processed} images, failed_count {counts.failed}, success_count {counts.success}")
+    if disk_budget is not None and disk_budget.pauses > 0:
+        print(f'paused {disk_budget.pauses} times for lack of disk space')
+    return counts
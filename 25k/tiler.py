@@ -0,0 +1,907 @@
+import os
+import io
+import gzip
+import json
+import mmap
+import time
+import heapq
+import bisect
+import shutil
+import hashlib
+from array import array
+from functools import partial
+from pathlib import Path
+from collections import OrderedDict
+from multiprocessing import Pool, cpu_count
+
+import mercantile
+import numpy as np
+from PIL import Image
+from osgeo import gdal, osr
+from pmtiles.reader import MmapSource, Reader, all_tiles
+from pmtiles.tile import (
+    Entry, Compression, TileType,
+    zxy_to_tileid, tileid_to_zxy, serialize_directory, serialize_header,
+)
+
+gdal.UseExceptions()
+
+TILE_SIZE = 256
+
+SUPPORTED_FORMATS = ['webp', 'jpeg', 'png']
+
+# datasets kept open per worker, the jobs are spatially ordered so neighbouring tiles hit the same sheets
+MAX_OPEN_DATASETS = 64
+
+# tiles per job handed to a worker
+JOB_SIZE = 64
+
+# jobs in flight while building the overviews, the children are read out only as fast as the pool keeps up
+OVERVIEW_WINDOW = 256
+
+BOUNDS_FILE_NAME = 'tile_bounds.jsonl'
+
+TILE_TYPES = {
+    'webp': TileType.WEBP,
+    'jpeg': TileType.JPEG,
+    'png': TileType.PNG,
+}
+
+# tile records held in memory by the pmtiles sink before they are sorted and spilled to a run file, about 32 bytes each
+RUN_SIZE = 1000000
+
+# only payloads up to this size are looked up for duplicates. The repeated tiles are the blank margins, the open sea
+# and the like, which encode small, and leaving out the big unique ones keeps the content table bounded
+DEDUP_MAX_SIZE = 16 * 1024
+
+PMTILES_HEADER_SIZE = 127
+# the header and the root directory have to fit in the first 16k
+MAX_ROOT_SIZE = 16384 - PMTILES_HEADER_SIZE
+LEAF_SIZE = 4096
+
+RECORD_DTYPE = np.dtype([('tile_id', '<u8'), ('seq', '<u8'), ('offset', '<u8'), ('length', '<u4')])
+
+# first tile id of every zoom, tile ids run through the zooms in order
+ZOOM_STARTS = [ (4 ** z - 1) // 3 for z in range(32) ]
+
+_datasets = OrderedDict()
+
+
+def get_tiff_files(gtiffs_dir):
+    return sorted(Path(gtiffs_dir).glob('*.tif'))
+
+
+def get_sheet_bounds(tiff_file):
+    ds = gdal.Open(str(tiff_file))
+    gt = ds.GetGeoTransform()
+    xs = [gt[0], gt[0] + ds.RasterXSize * gt[1]]
+    ys = [gt[3], gt[3] + ds.RasterYSize * gt[5]]
+
+    src_srs = ds.GetSpatialRef()
+    src_srs.SetAxisMappingStrategy(osr.OAMS_TRADITIONAL_GIS_ORDER)
+    dst_srs = osr.SpatialReference()
+    dst_srs.ImportFromEPSG(4326)
+    dst_srs.SetAxisMappingStrategy(osr.OAMS_TRADITIONAL_GIS_ORDER)
+    transform = osr.CoordinateTransformation(src_srs, dst_srs)
+    west, south, east, north = transform.TransformBounds(min(xs), min(ys), max(xs), max(ys), 21)
+    return (west, south, east, north)
+
+
+def get_bounds_tiles(bounds, zoom):
+    west, south, east, north = bounds
+    return mercantile.tiles(west, south, east, north, [zoom])
+
+
+def get_full_tile_index(all_bounds, zooms):
+    # maps every tile to the sheets it has to be composited from
+    tile_index = {}
+    for sheet_id in sorted(all_bounds.keys()):
+        entry = all_bounds[sheet_id]
+        for zoom in zooms:
+            for tile in get_bounds_tiles(entry['bounds'], zoom):
+                tile_index.setdefault(tile, []).append(entry['path'])
+    return tile_index
+
+
+def get_changed_tile_index(all_bounds, changed_bounds, zooms):
+    # the tiles touched by the changed sheets, along with every sheet, changed or not, which shows up in them
+    tiles = set()
+    for bounds in changed_bounds:
+        for zoom in zooms:
+            tiles.update(get_bounds_tiles(bounds, zoom))
+
+    sheet_ids = sorted(all_bounds.keys())
+    paths = [ all_bounds[sheet_id]['path'] for sheet_id in sheet_ids ]
+    sheet_bounds = np.array([ all_bounds[sheet_id]['bounds'] for sheet_id in sheet_ids ]).reshape(-1, 4)
+
+    tile_index = {}
+    for tile in tiles:
+        tb = mercantile.bounds(tile)
+        overlaps = ((sheet_bounds[:, 0] < tb.east) & (sheet_bounds[:, 2] > tb.west) &
+                    (sheet_bounds[:, 1] < tb.north) & (sheet_bounds[:, 3] > tb.south))
+        # a tile left without any sheet is one that only a removed sheet covered
+        tile_index[tile] = [ paths[i] for i in np.flatnonzero(overlaps) ]
+    return tile_index
+
+
+class BoundsIndex:
+    """
+    Lat/lon bounds of all the sheet gtiffs of a directory in a json lines file kept next to them,
+    keyed by sheet id and invalidated by size and mtime, so that only new or replaced sheets are opened.
+    """
+    def __init__(self, gtiffs_dir):
+        self.gtiffs_dir = Path(gtiffs_dir)
+        self.bounds_file = self.gtiffs_dir / BOUNDS_FILE_NAME
+        self.entries = {}
+        # sheets whose gtiff is gone but which are kept in the index until they are asked to be updated
+        self.missing = set()
+        if self.bounds_file.exists():
+            with open(self.bounds_file, 'r') as f:
+                for line in f:
+                    if line.strip() == '':
+                        continue
+                    entry = json.loads(line)
+                    self.entries[entry['id']] = entry
+
+    def is_fresh(self, entry, st):
+        return entry['size'] == st.st_size and entry['mtime_ns'] == st.st_mtime_ns
+
+    def update(self, tiff_files, pool, sheet_ids=None, save=True):
+        """
+        Returns the entries of the sheets which were replaced or are gone, as they were before the update.
+        With sheet_ids given only those sheets are updated, the other changed sheets are still returned
+        but are left stale in the index, so that a later update finds them changed again.
+        """
+        stale = []
+        old = {}
+        seen = set()
+        for tiff_file in tiff_files:
+            tiff_file = Path(tiff_file)
+            seen.add(tiff_file.stem)
+            st = tiff_file.stat()
+            entry = self.entries.get(tiff_file.stem)
+            if entry is not None and self.is_fresh(entry, st):
+                continue
+            if entry is not None:
+                old[tiff_file.stem] = entry
+            if sheet_ids is None or tiff_file.stem in sheet_ids:
+                stale.append((tiff_file, st))
+
+        all_bounds = pool.map(get_sheet_bounds, [ str(tiff_file) for tiff_file, _ in stale ], chunksize=64)
+        for (tiff_file, st), bounds in zip(stale, all_bounds):
+            self.entries[tiff_file.stem] = {
+                'id': tiff_file.stem,
+                'size': st.st_size,
+                'mtime_ns': st.st_mtime_ns,
+                'bounds': list(bounds),
+            }
+
+        removed = 0
+        for sheet_id in set(self.entries.keys()) - seen:
+            old[sheet_id] = self.entries[sheet_id]
+            if sheet_ids is None or sheet_id in sheet_ids:
+                del self.entries[sheet_id]
+                removed += 1
+            else:
+                self.missing.add(sheet_id)
+
+        if save and (stale or removed):
+            self.save()
+        return old
+
+    def save(self):
+        tmp_file = self.bounds_file.with_suffix('.jsonl.tmp')
+        with open(tmp_file, 'w') as f:
+            for sheet_id in sorted(self.entries.keys()):
+                f.write(json.dumps(self.entries[sheet_id]) + '\n')
+        tmp_file.replace(self.bounds_file)
+
+    def get_all(self):
+        return { sheet_id: { 'path': str(self.gtiffs_dir / f'{sheet_id}.tif'), 'bounds': entry['bounds'] }
+                 for sheet_id, entry in self.entries.items() if sheet_id not in self.missing }
+
+
+def get_dataset(tiff_file):
+    ds = _datasets.pop(tiff_file, None)
+    if ds is None:
+        ds = gdal.Open(tiff_file)
+    _datasets[tiff_file] = ds
+    while len(_datasets) > MAX_OPEN_DATASETS:
+        _datasets.popitem(last=False)
+    return ds
+
+
+def render_tile(tile, tiff_files, resampling):
+    # all the sheets touching the tile are warped into it in one go, the masks of the sheets decide which one shows where
+    west, south, east, north = mercantile.xy_bounds(tile)
+    datasets = [ get_dataset(f) for f in sorted(tiff_files) ]
+    out = gdal.Warp('', datasets, format='MEM',
+                    outputBounds=(west, south, east, north), dstSRS='EPSG:3857',
+                    width=TILE_SIZE, height=TILE_SIZE,
+                    resampleAlg=resampling, dstAlpha=True)
+    if out.RasterCount != 4:
+        raise Exception(f'expected 3 bands and alpha for {tile}, got {out.RasterCount} bands')
+    # the alpha is checked on its own first, so that fully transparent tiles are never read out or encoded
+    if not out.GetRasterBand(4).ReadAsArray().any():
+        return None
+    rgba = out.ReadAsArray()
+    return np.ascontiguousarray(rgba.transpose(1, 2, 0))
+
+
+def encode_tile(rgba, tile_format, quality):
+    buf = io.BytesIO()
+    if tile_format == 'webp':
+        Image.fromarray(rgba, 'RGBA').save(buf, format='WEBP', quality=quality)
+    elif tile_format == 'jpeg':
+        Image.fromarray(rgba[:, :, :3], 'RGB').save(buf, format='JPEG', quality=quality)
+    elif tile_format == 'png':
+        Image.fromarray(rgba, 'RGBA').save(buf, format='PNG', optimize=True)
+    else:
+        raise ValueError(f'Unsupported tile format: {tile_format}, {SUPPORTED_FORMATS=}')
+    return buf.getvalue()
+
+
+def init_worker(gdal_cache_mb):
+    gdal.SetCacheMax(gdal_cache_mb * 1024 * 1024)
+
+
+def tile_job(job, tile_format, quality, resampling):
+    results = []
+    for tile, tiff_files in job:
+        if len(tiff_files) == 0:
+            results.append((tile, None, None))
+            continue
+        try:
+            rgba = render_tile(tile, tiff_files, resampling)
+            if rgba is None:
+                results.append((tile, None, None))
+                continue
+            results.append((tile, encode_tile(rgba, tile_format, quality), None))
+        except Exception as ex:
+            results.append((tile, None, f'{type(ex).__name__}: {ex}'))
+    return results
+
+
+def decode_tile(data):
+    return np.asarray(Image.open(io.BytesIO(data)).convert('RGBA'))
+
+
+def downsample(canvas):
+    # 2x2 box filter weighted by alpha, so that the transparent surroundings of the sheets don't darken their edges
+    blocks = canvas.reshape(TILE_SIZE, 2, TILE_SIZE, 2, 4).astype(np.uint32)
+    alpha = blocks[..., 3]
+    alpha_sum = alpha.sum(axis=(1, 3))
+    if not alpha_sum.any():
+        return None
+    rgb = (blocks[..., :3] * alpha[..., None]).sum(axis=(1, 3))
+    rgb = (rgb + alpha_sum[..., None] // 2) // np.maximum(alpha_sum, 1)[..., None]
+    out = np.empty((TILE_SIZE, TILE_SIZE, 4), dtype=np.uint8)
+    out[..., :3] = rgb
+    out[..., 3] = (alpha_sum + 2) // 4
+    return out
+
+
+def overview_job(job, tile_format, quality):
+    results = []
+    for tile, children in job:
+        try:
+            canvas = np.zeros((2 * TILE_SIZE, 2 * TILE_SIZE, 4), dtype=np.uint8)
+            for (dx, dy), data in children.items():
+                canvas[dy * TILE_SIZE:(dy + 1) * TILE_SIZE, dx * TILE_SIZE:(dx + 1) * TILE_SIZE] = decode_tile(data)
+            rgba = downsample(canvas)
+            if rgba is None:
+                results.append((tile, None, None))
+                continue
+            results.append((tile, encode_tile(rgba, tile_format, quality), None))
+        except Exception as ex:
+            results.append((tile, None, f'{type(ex).__name__}: {ex}'))
+    return results
+
+
+def get_parent_groups(tiles):
+    # the four children of a tile come one after the other in the stream, so only one group is held at a time
+    parent = None
+    children = {}
+    for tile, data in tiles:
+        tile_parent = mercantile.Tile(tile.x // 2, tile.y // 2, tile.z - 1)
+        if parent is not None and tile_parent != parent:
+            yield parent, children
+            children = {}
+        parent = tile_parent
+        children[(tile.x % 2, tile.y % 2)] = data
+    if parent is not None:
+        yield parent, children
+
+
+def get_jobs(tile_index, job_size=JOB_SIZE):
+    # neighbouring tiles go to the same job, so that a worker keeps reading from the same few sheets
+    def block_key(tile):
+        return (tile.z, tile.x // 16, tile.y // 16, tile.x, tile.y)
+
+    tiles = sorted(tile_index.keys(), key=block_key)
+    jobs = []
+    for i in range(0, len(tiles), job_size):
+        jobs.append([ (tile, tile_index[tile]) for tile in tiles[i:i + job_size] ])
+    return jobs
+
+
+class DirTileSink:
+    """
+    Writes the tiles out as a z/x/y tree, like gdal2tiles --xyz does.
+    """
+    def __init__(self, tiles_dir, tile_format):
+        self.dir = Path(tiles_dir)
+        self.ext = tile_format
+
+    def get_tile_file(self, tile):
+        return self.dir / str(tile.z) / str(tile.x) / f'{tile.y}.{self.ext}'
+
+    def has(self, tile):
+        return self.get_tile_file(tile).exists()
+
+    def put(self, tile, data):
+        tile_file = self.get_tile_file(tile)
+        tile_file.parent.mkdir(parents=True, exist_ok=True)
+        tmp_file = tile_file.with_name(tile_file.name + '.tmp')
+        tmp_file.write_bytes(data)
+        os.replace(tmp_file, tile_file)
+
+    def delete(self, tile):
+        self.get_tile_file(tile).unlink(missing_ok=True)
+
+    def get(self, tile):
+        tile_file = self.get_tile_file(tile)
+        if not tile_file.exists():
+            return None
+        return tile_file.read_bytes()
+
+    def get_tiles(self, zoom):
+        zoom_dir = self.dir / str(zoom)
+        if not zoom_dir.exists():
+            return
+        tiles = []
+        for x_dir in zoom_dir.iterdir():
+            for tile_file in x_dir.glob(f'*.{self.ext}'):
+                tiles.append(mercantile.Tile(int(x_dir.name), int(tile_file.stem), zoom))
+        # siblings next to each other
+        tiles.sort(key=lambda t: (t.x // 2, t.y // 2, t.x, t.y))
+        for tile in tiles:
+            yield tile, self.get_tile_file(tile).read_bytes()
+
+    def close(self, metadata=None):
+        if metadata is None:
+            return
+        self.dir.mkdir(parents=True, exist_ok=True)
+        # not really a tilejson, just what is needed to populate the pmtiles metadata
+        (self.dir / 'metadata.json').write_text(json.dumps(metadata, indent=2))
+
+
+def get_pmtiles_header(pmtiles_file):
+    with open(pmtiles_file, 'rb') as f:
+        return Reader(MmapSource(f)).header()
+
+
+def get_tile_format(tile_type):
+    for tile_format, t in TILE_TYPES.items():
+        if t == tile_type:
+            return tile_format
+    raise ValueError(f'Unsupported pmtiles tile type: {tile_type}, {SUPPORTED_FORMATS=}')
+
+
+def read_run(run_file, chunk_size=65536):
+    records = np.memmap(run_file, dtype=RECORD_DTYPE, mode='r')
+    for i in range(0, len(records), chunk_size):
+        yield from records[i:i + chunk_size].tolist()
+
+
+def get_batches(items, batch_size):
+    batch = []
+    for item in items:
+        batch.append(item)
+        if len(batch) == batch_size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+def get_zoom(tile_id):
+    return bisect.bisect_right(ZOOM_STARTS, tile_id) - 1
+
+
+class PMTilesSink:
+    """
+    Streams the tiles straight into a pmtiles archive, no file per tile is ever written.
+    The tile data is appended to a spool file in whatever order the pool hands the tiles over, and only
+    (tile id, seq, offset, length) records are kept, sorted and spilled to run files every RUN_SIZE tiles.
+    On close the runs are merged to lay out the directories and the tile data in tile id order,
+    so the memory used stays bounded however many tiles there are.
+
+    Payloads are content addressed, a tile identical to one already spooled only gets a record pointing
+    at the earlier data, and runs of consecutive tile ids with the same content become a single entry.
+    """
+    def __init__(self, pmtiles_file, tile_format, run_size=RUN_SIZE):
+        self.file = Path(pmtiles_file)
+        self.tile_format = tile_format
+        self.run_size = run_size
+        self.parts_dir = self.file.with_name(self.file.name + '.parts')
+        shutil.rmtree(self.parts_dir, ignore_errors=True)
+        self.parts_dir.mkdir(parents=True)
+        self.spool_file = self.parts_dir / 'tiles.bin'
+        self.spool = open(self.spool_file, 'wb')
+        self.spool_size = 0
+        self.seq = 0
+        self.tile_ids = array('Q')
+        self.offsets = array('Q')
+        self.lengths = array('L')
+        self.run_files = []
+        # digest to the spool offset and the number of puts of the content
+        self.contents = {}
+        # zoom to the min x, min y, max x, max y of the tiles seen, for the bounds in the header
+        self.extents = {}
+
+    def has(self, tile):
+        # there is nothing to resume from, the archive is only put together on close
+        return False
+
+    def add_record(self, tile_id, offset, length):
+        self.tile_ids.append(tile_id)
+        self.offsets.append(offset)
+        self.lengths.append(length)
+        if len(self.tile_ids) >= self.run_size:
+            self.flush_run()
+
+    def spool_data(self, data):
+        if len(data) <= DEDUP_MAX_SIZE:
+            digest = hashlib.blake2b(data, digest_size=16).digest()
+            content = self.contents.get(digest)
+            if content is not None:
+                content[1] += 1
+                return content[0]
+            self.contents[digest] = [self.spool_size, 1]
+        offset = self.spool_size
+        self.spool.write(data)
+        self.spool_size += len(data)
+        return offset
+
+    def put(self, tile, data):
+        offset = self.spool_data(data)
+        self.add_record(zxy_to_tileid(tile.z, tile.x, tile.y), offset, len(data))
+        extent = self.extents.setdefault(tile.z, [tile.x, tile.y, tile.x, tile.y])
+        extent[0], extent[1] = min(extent[0], tile.x), min(extent[1], tile.y)
+        extent[2], extent[3] = max(extent[2], tile.x), max(extent[3], tile.y)
+
+    def delete(self, tile):
+        # a zero length record, the later record for a tile always wins in the merge
+        self.add_record(zxy_to_tileid(tile.z, tile.x, tile.y), 0, 0)
+
+    def flush_run(self):
+        if len(self.tile_ids) == 0:
+            return
+        count = len(self.tile_ids)
+        records = np.empty(count, dtype=RECORD_DTYPE)
+        records['tile_id'] = np.frombuffer(self.tile_ids, dtype=np.uint64)
+        records['seq'] = np.arange(self.seq, self.seq + count, dtype=np.uint64)
+        records['offset'] = np.frombuffer(self.offsets, dtype=np.uint64)
+        records['length'] = np.array(self.lengths, dtype=np.uint32)
+        records.sort(order=['tile_id', 'seq'])
+        run_file = self.parts_dir / f'run_{len(self.run_files):05d}.bin'
+        records.tofile(run_file)
+        self.run_files.append(run_file)
+        self.seq += count
+        self.tile_ids = array('Q')
+        self.offsets = array('Q')
+        self.lengths = array('L')
+
+    def get_records(self):
+        # k way merge of the sorted runs, the last put of a tile comes last
+        prev = None
+        for record in heapq.merge(*[ read_run(run_file) for run_file in self.run_files ]):
+            if prev is not None and prev[0] != record[0] and prev[3] > 0:
+                yield prev
+            prev = record
+        if prev is not None and prev[3] > 0:
+            yield prev
+
+    def get_tiles(self, zoom):
+        # tile id order, which being along a hilbert curve keeps the four children of a tile together
+        self.flush_run()
+        self.spool.flush()
+        if self.spool_size == 0:
+            return
+        start, end = ZOOM_STARTS[zoom], ZOOM_STARTS[zoom + 1]
+        with open(self.spool_file, 'rb') as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            for tile_id, _, offset, length in self.get_records():
+                if tile_id < start:
+                    continue
+                if tile_id >= end:
+                    break
+                z, x, y = tileid_to_zxy(tile_id)
+                yield mercantile.Tile(x, y, z), mm[offset:offset + length]
+
+    def get_placements(self, shared):
+        """
+        Yields tile id, spool offset, length, archive offset and whether the data is to be written there.
+        Content put more than once is written on its first tile and pointed at afterwards.
+        """
+        offset = 0
+        placed = {}
+        for tile_id, _, spool_offset, length in self.get_records():
+            if spool_offset in shared:
+                if spool_offset in placed:
+                    yield tile_id, spool_offset, length, placed[spool_offset], False
+                    continue
+                placed[spool_offset] = offset
+            yield tile_id, spool_offset, length, offset, True
+            offset += length
+
+    def get_entries(self, shared):
+        prev = None
+        for tile_id, _, length, offset, _ in self.get_placements(shared):
+            if prev is not None and tile_id == prev.tile_id + prev.run_length and offset == prev.offset:
+                prev.run_length += 1
+                continue
+            if prev is not None:
+                yield prev
+            prev = Entry(tile_id, offset, length, 1)
+        if prev is not None:
+            yield prev
+
+    def write_directories(self, leaves_file, shared):
+        # small archives get by with just a root directory
+        head = []
+        for entry in self.get_entries(shared):
+            head.append(entry)
+            if len(head) > LEAF_SIZE:
+                break
+        if len(head) <= LEAF_SIZE:
+            root = serialize_directory(head)
+            if len(root) <= MAX_ROOT_SIZE:
+                leaves_file.write_bytes(b'')
+                return root, len(head)
+
+        leaf_size = LEAF_SIZE
+        while True:
+            root_entries = []
+            leaves_length = 0
+            num_entries = 0
+            with open(leaves_file, 'wb') as f:
+                for batch in get_batches(self.get_entries(shared), leaf_size):
+                    leaf = serialize_directory(batch)
+                    root_entries.append(Entry(batch[0].tile_id, leaves_length, len(leaf), 0))
+                    f.write(leaf)
+                    leaves_length += len(leaf)
+                    num_entries += len(batch)
+            root = serialize_directory(root_entries)
+            if len(root) <= MAX_ROOT_SIZE:
+                return root, num_entries
+            leaf_size *= 2
+
+    def get_header(self):
+        max_zoom = max(self.extents.keys())
+        min_x, min_y, max_x, max_y = self.extents[max_zoom]
+        west, _, _, north = mercantile.bounds(min_x, min_y, max_zoom)
+        _, south, east, _ = mercantile.bounds(max_x, max_y, max_zoom)
+        return {
+            'clustered': True,
+            'internal_compression': Compression.GZIP,
+            'tile_compression': Compression.NONE,
+            'tile_type': TILE_TYPES[self.tile_format],
+            'min_zoom': min(self.extents.keys()),
+            'max_zoom': max_zoom,
+            'min_lon_e7': int(west * 10000000),
+            'min_lat_e7': int(south * 10000000),
+            'max_lon_e7': int(east * 10000000),
+            'max_lat_e7': int(north * 10000000),
+            'center_zoom': min(self.extents.keys()),
+            'center_lon_e7': int((west + east) / 2 * 10000000),
+            'center_lat_e7': int((south + north) / 2 * 10000000),
+        }
+
+    def report(self, by_zoom):
+        # stored counts the content first written at the zoom, a zoom made up of only repeats of lower zooms stores none
+        print('zoom      tiles     stored  dedup ratio   saved MB')
+        rows = [ (zoom, *by_zoom[zoom]) for zoom in sorted(by_zoom.keys()) ]
+        rows.append(('all', *[ sum(c[i] for c in by_zoom.values()) for i in range(4) ]))
+        for zoom, tiles, stored, total_bytes, stored_bytes in rows:
+            ratio = f'{tiles / stored:12.2f}' if stored > 0 else f'{"-":>12}'
+            print(f'{zoom:>4} {tiles:10d} {stored:10d} {ratio} {(total_bytes - stored_bytes) / (1024 * 1024):10.1f}')
+
+    def close(self, metadata=None):
+        self.flush_run()
+        self.spool.close()
+        if not self.run_files:
+            raise Exception(f'no tiles to write to {self.file}')
+
+        # only the offsets of content put more than once need remembering while laying out the archive
+        shared = set(offset for offset, count in self.contents.values() if count > 1)
+        self.contents = {}
+
+        leaves_file = self.parts_dir / 'leaves.bin'
+        root, num_entries = self.write_directories(leaves_file, shared)
+        compressed_metadata = gzip.compress(json.dumps(metadata or {}).encode())
+
+        header = self.get_header()
+        header['root_offset'] = PMTILES_HEADER_SIZE
+        header['root_length'] = len(root)
+        header['metadata_offset'] = header['root_offset'] + header['root_length']
+        header['metadata_length'] = len(compressed_metadata)
+        header['leaf_directory_offset'] = header['metadata_offset'] + header['metadata_length']
+        header['leaf_directory_length'] = leaves_file.stat().st_size
+        header['tile_data_offset'] = header['leaf_directory_offset'] + header['leaf_directory_length']
+        header['tile_entries_count'] = num_entries
+
+        # zoom to tiles, tiles stored, bytes and bytes stored
+        by_zoom = {}
+        tmp_file = self.file.with_name(self.file.name + '.tmp')
+        with open(tmp_file, 'wb') as f:
+            # the header is only complete once the tile data is written, it goes in last
+            f.write(b'\0' * PMTILES_HEADER_SIZE)
+            f.write(root)
+            f.write(compressed_metadata)
+            with open(leaves_file, 'rb') as f_leaves:
+                shutil.copyfileobj(f_leaves, f)
+            with open(self.spool_file, 'rb') as f_spool, mmap.mmap(f_spool.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+                for tile_id, spool_offset, length, _, is_new in self.get_placements(shared):
+                    counts = by_zoom.setdefault(get_zoom(tile_id), [0, 0, 0, 0])
+                    counts[0] += 1
+                    counts[2] += length
+                    if is_new:
+                        f.write(mm[spool_offset:spool_offset + length])
+                        counts[1] += 1
+                        counts[3] += length
+            header['addressed_tiles_count'] = sum(c[0] for c in by_zoom.values())
+            header['tile_contents_count'] = sum(c[1] for c in by_zoom.values())
+            header['tile_data_length'] = sum(c[3] for c in by_zoom.values())
+            f.seek(0)
+            f.write(serialize_header(header))
+        tmp_file.replace(self.file)
+        shutil.rmtree(self.parts_dir, ignore_errors=True)
+        print(f'wrote {header["addressed_tiles_count"]} tiles to {self.file}, '
+              f'{header["tile_contents_count"]} distinct in {num_entries} entries')
+        self.report(by_zoom)
+
+
+class PMTilesUpdateSink:
+    """
+    Holds on to the re-rendered tiles and merges them into an existing pmtiles archive on close.
+    The untouched tiles are copied over as they are, nothing in the archive gets decoded again.
+    """
+    def __init__(self, pmtiles_file):
+        self.file = Path(pmtiles_file)
+        # tile id to the new tile data, None for the tiles which are to be dropped
+        self.updates = {}
+        self.reader = None
+
+    def has(self, tile):
+        return zxy_to_tileid(tile.z, tile.x, tile.y) in self.updates
+
+    def get(self, tile):
+        # the tile as it will be after the update, for rebuilding the overviews above the retiled tiles
+        tile_id = zxy_to_tileid(tile.z, tile.x, tile.y)
+        if tile_id in self.updates:
+            return self.updates[tile_id]
+        if self.reader is None:
+            with open(self.file, 'rb') as f:
+                self.reader = Reader(MmapSource(f))
+        return self.reader.get(tile.z, tile.x, tile.y)
+
+    def put(self, tile, data):
+        self.updates[zxy_to_tileid(tile.z, tile.x, tile.y)] = data
+
+    def delete(self, tile):
+        self.updates[zxy_to_tileid(tile.z, tile.x, tile.y)] = None
+
+    def close(self, metadata=None):
+        self.reader = None
+        counts = { 'replaced': 0, 'added': 0, 'removed': 0 }
+        with open(self.file, 'rb') as f:
+            get_bytes = MmapSource(f)
+            reader = Reader(get_bytes)
+            if metadata is None:
+                metadata = reader.metadata()
+            sink = PMTilesSink(self.file, get_tile_format(reader.header()['tile_type']))
+            for (z, x, y), data in all_tiles(get_bytes):
+                tile_id = zxy_to_tileid(z, x, y)
+                if tile_id in self.updates:
+                    counts['replaced' if self.updates[tile_id] is not None else 'removed'] += 1
+                    continue
+                sink.put(mercantile.Tile(x, y, z), data)
+
+        for tile_id, data in self.updates.items():
+            if data is None:
+                continue
+            z, x, y = tileid_to_zxy(tile_id)
+            sink.put(mercantile.Tile(x, y, z), data)
+        counts['added'] = sum(1 for data in self.updates.values() if data is not None) - counts['replaced']
+        sink.close(metadata)
+        print(f'updated {self.file}: {counts["replaced"]} tiles replaced, {counts["added"]} added, {counts["removed"]} removed')
+
+
+class TileStats:
+    def __init__(self):
+        self.start = time.time()
+        self.written = 0
+        self.transparent = 0
+        self.transparent_by_zoom = {}
+        self.existing = 0
+        self.failed = []
+        self.bytes = 0
+
+    def __str__(self):
+        elapsed = time.time() - self.start
+        done = self.written + self.transparent + len(self.failed)
+        return (f'{self.written} tiles written ({self.bytes / (1024 * 1024):.1f} MB), {self.transparent} transparent, '
+                f'{self.existing} already present, {len(self.failed)} failed in {elapsed:.1f} secs, '
+                f'{done / max(elapsed, 1e-6):.1f} tiles/sec')
+
+
+def get_metadata(tile_format, name, description, attribution, min_zoom, max_zoom):
+    return {
+        'type': 'baselayer',
+        'format': tile_format,
+        'attribution': attribution,
+        'description': description,
+        'name': name,
+        'version': '1',
+        'maxzoom': max_zoom,
+        'minzoom': min_zoom,
+    }
+
+
+def get_pool(workers, gdal_cache_mb):
+    return Pool(workers or cpu_count(), initializer=init_worker, initargs=(gdal_cache_mb,))
+
+
+def put_results(results, sink, stats, replace=False):
+    # with replace set, the tiles which come out transparent are dropped from the sink, they might have had data before
+    for tile, data, error in results:
+        if error is not None:
+            stats.failed.append((tile, error))
+            print(f'failed to render {tile}: {error}')
+        elif data is None:
+            stats.transparent += 1
+            stats.transparent_by_zoom[tile.z] = stats.transparent_by_zoom.get(tile.z, 0) + 1
+            if replace:
+                sink.delete(tile)
+        else:
+            sink.put(tile, data)
+            stats.written += 1
+            stats.bytes += len(data)
+
+
+def render_tiles(pool, tile_index, sink, stats, tile_format, quality, resampling, replace=False):
+    jobs = get_jobs(tile_index)
+    fn = partial(tile_job, tile_format=tile_format, quality=quality, resampling=resampling)
+    for i, results in enumerate(pool.imap_unordered(fn, jobs)):
+        put_results(results, sink, stats, replace=replace)
+        if (i + 1) % 100 == 0 or i + 1 == len(jobs):
+            print(f'{i + 1}/{len(jobs)} jobs done, {stats}')
+
+
+def build_overviews(pool, sink, stats, base_zoom, min_zoom, tile_format, quality):
+    """
+    Builds every zoom below the base zoom from the four already encoded tiles under each tile, one zoom at a time
+    from the bottom up, instead of warping the sheets again. The children are streamed out of the sink in
+    windows of jobs, so only what the pool is working on is held in memory.
+    """
+    fn = partial(overview_job, tile_format=tile_format, quality=quality)
+    for zoom in range(base_zoom - 1, min_zoom - 1, -1):
+        start_written = stats.written
+        jobs = get_batches(get_parent_groups(sink.get_tiles(zoom + 1)), JOB_SIZE)
+        for window in get_batches(jobs, OVERVIEW_WINDOW):
+            for results in pool.imap_unordered(fn, window):
+                # a tile which comes out transparent now can't be left behind from an earlier run
+                put_results(results, sink, stats, replace=True)
+        print(f'zoom {zoom}: {stats.written - start_written} overview tiles, {stats}')
+
+
+def get_child_groups(sink, parents):
+    for parent in parents:
+        children = {}
+        for dx in (0, 1):
+            for dy in (0, 1):
+                data = sink.get(mercantile.Tile(parent.x * 2 + dx, parent.y * 2 + dy, parent.z + 1))
+                if data is not None:
+                    children[(dx, dy)] = data
+        yield parent, children
+
+
+def rebuild_ancestors(pool, sink, stats, tiles, base_zoom, min_zoom, tile_format, quality):
+    """
+    Builds again the overview tiles above the given base zoom tiles, up to the min zoom, from the four
+    children of each, which come from the sink as it is after this run's updates. A parent left with
+    no children, or only transparent ones, is dropped.
+    """
+    fn = partial(overview_job, tile_format=tile_format, quality=quality)
+    changed = set(tiles)
+    for zoom in range(base_zoom - 1, min_zoom - 1, -1):
+        start_written = stats.written
+        parents = sorted(set(mercantile.Tile(t.x // 2, t.y // 2, zoom) for t in changed), key=lambda t: (t.x, t.y))
+        jobs = get_batches(get_child_groups(sink, parents), JOB_SIZE)
+        for window in get_batches(jobs, OVERVIEW_WINDOW):
+            for results in pool.imap_unordered(fn, window):
+                put_results(results, sink, stats, replace=True)
+        print(f'zoom {zoom}: {len(parents)} overview tiles rebuilt, {stats.written - start_written} written, {stats}')
+        changed = parents
+
+
+def check_format(tile_format):
+    if tile_format not in SUPPORTED_FORMATS:
+        raise ValueError(f'Unsupported tile format: {tile_format}, {SUPPORTED_FORMATS=}')
+
+
+def tile_tiffs(gtiffs_dir, sink, min_zoom, max_zoom, tile_format='webp', quality=75,
+               resampling='lanczos', workers=None, resume=True, gdal_cache_mb=256, overviews=True):
+    """
+    Renders every tile touched by the sheets straight from the sheet gtiffs, compositing the sheets
+    which share a tile, and hands the encoded tiles to the sink. With overviews set only the max zoom
+    is warped and the lower zooms are downsampled from it, otherwise every zoom is warped.
+    """
+    check_format(tile_format)
+    zooms = [max_zoom] if overviews else list(range(min_zoom, max_zoom + 1))
+    stats = TileStats()
+
+    with get_pool(workers, gdal_cache_mb) as pool:
+        bounds_index = BoundsIndex(gtiffs_dir)
+        tiff_files = get_tiff_files(gtiffs_dir)
+        print(f'reading the bounds of {len(tiff_files)} sheets')
+        bounds_index.update(tiff_files, pool)
+        tile_index = get_full_tile_index(bounds_index.get_all(), zooms)
+        print(f'{len(tile_index)} tiles at zooms {zooms[0]}-{zooms[-1]}')
+
+        if resume:
+            existing = [ tile for tile in tile_index if sink.has(tile) ]
+            for tile in existing:
+                del tile_index[tile]
+            stats.existing = len(existing)
+
+        render_tiles(pool, tile_index, sink, stats, tile_format, quality, resampling)
+
+        if overviews:
+            # always built again, a resumed run could have changed tiles under them
+            build_overviews(pool, sink, stats, max_zoom, min_zoom, tile_format, quality)
+
+    return stats
+
+
+def retile_sheets(gtiffs_dir, changed_ids, sink, min_zoom, max_zoom, tile_format='webp', quality=75,
+                  resampling='lanczos', workers=None, gdal_cache_mb=256, overviews=True):
+    """
+    Renders again only the tiles which the changed sheets touch, along with the neighbouring sheets
+    which share those tiles. Works for added, replaced and removed sheets. With overviews set only the
+    max zoom is warped and the tiles above it are downsampled again from their children, like tile_tiffs()
+    builds them, otherwise every zoom is warped. The sink is closed here, and the bounds of the changed
+    sheets are saved only after that, so an interrupted run finds the same sheets changed when run again.
+    """
+    check_format(tile_format)
+    zooms = [max_zoom] if overviews else list(range(min_zoom, max_zoom + 1))
+    stats = TileStats()
+
+    with get_pool(workers, gdal_cache_mb) as pool:
+        bounds_index = BoundsIndex(gtiffs_dir)
+        old = bounds_index.update(get_tiff_files(gtiffs_dir), pool, sheet_ids=set(changed_ids), save=False)
+
+        changed_bounds = []
+        for sheet_id in changed_ids:
+            # a replaced sheet clears the tiles of its old footprint as well as filling its new one
+            found = [ entries[sheet_id]['bounds'] for entries in [old, bounds_index.entries] if sheet_id in entries ]
+            if not found:
+                print(f'{sheet_id} is neither in {gtiffs_dir} nor in its {BOUNDS_FILE_NAME}, skipping it')
+            changed_bounds.extend(found)
+
+        unasked = sorted(set(old.keys()) - set(changed_ids))
+        if unasked:
+            print(f'{len(unasked)} other sheets changed since the bounds were last read, they are not retiled and are left stale in {BOUNDS_FILE_NAME}: {" ".join(unasked)}')
+
+        tile_index = get_changed_tile_index(bounds_index.get_all(), changed_bounds, zooms)
+        print(f'{len(tile_index)} tiles at zooms {zooms[0]}-{zooms[-1]} touched by {len(changed_ids)} sheets')
+        render_tiles(pool, tile_index, sink, stats, tile_format, quality, resampling, replace=True)
+
+        if overviews:
+            rebuild_ancestors(pool, sink, stats, tile_index.keys(), max_zoom, min_zoom, tile_format, quality)
+
+    # the metadata of the archive or the tiles dir is kept as it is
+    sink.close()
+    bounds_index.save()
+    return stats
@@ -0,0 +1,102 @@
+# /// script
+# requires-python = ">=3.12"
+# dependencies = [
+#     "topo-map-processor[parse]",
+# ]
+#
+# [tool.uv.sources]
+# topo-map-processor = { path = "../../topo_map_processor", editable = true }
+# ///
+
+# times the per sheet coordinate transforms, one call per point against one call per batch
+# usage: uv run bench_transforms.py [num_sheets] [cutline_points]
+
+import sys
+import time
+
+from topo_map_processor.processor import GCPBasedTransformer
+
+from crs_registry import (
+    get_transformer, get_geodetic_transformer,
+    transform_points, project_gcps, coords_to_pixels, pixels_to_coords,
+)
+
+# a 500k sheet, 3x2 degrees, in gauss-kruger zone 7 on pulkovo 1942
+CRS_PROJ = '+proj=tmerc +lat_0=0 +lon_0=39 +k=1 +x_0=7500000 +y_0=0 +ellps=krass +towgs84=23.92,-141.27,-80.9,0,0.35,0.82,-0.12 +units=m +no_defs'
+WIDTH, HEIGHT = 9000, 7000
+WEST, NORTH, EAST, SOUTH = 36.0, 56.0, 42.0, 52.0
+
+
+def get_sheet(cutline_points):
+    corners = [(0, 0), (WIDTH, 0), (WIDTH, HEIGHT), (0, HEIGHT)]
+    refs = [(WEST, NORTH), (EAST, NORTH), (EAST, SOUTH), (WEST, SOUTH)]
+    gcps = [ (c, r) for c, r in zip(corners, refs) ]
+
+    # the cutline runs along the sheet edges, densified like the ones from process_antimeridian
+    per_side = max(cutline_points // 4, 1)
+    cutline = []
+    for (x0, y0), (x1, y1) in zip(refs, refs[1:] + refs[:1]):
+        for i in range(per_side):
+            f = i / per_side
+            cutline.append((x0 + (x1 - x0) * f, y0 + (y1 - y0) * f))
+    cutline.append(cutline[0])
+    return gcps, corners, cutline
+
+
+def run_per_point(gcps, corners, cutline):
+    transformer = get_geodetic_transformer(CRS_PROJ)
+    projected_gcps = []
+    for gcp in gcps:
+        projected_gcps.append((gcp[0], transformer.transform(gcp[1][0], gcp[1][1])))
+
+    proj_transformer = GCPBasedTransformer(projected_gcps)
+    projected_corners = [ proj_transformer.xy(c[1], c[0]) for c in corners ]
+
+    gcp_transformer = GCPBasedTransformer(gcps)
+    pixels = [ gcp_transformer.rowcol(p[0], p[1]) for p in cutline[:-1] ]
+
+    datum_transformer = get_transformer('EPSG:4284', 'EPSG:4326')
+    cutline_4326 = [ datum_transformer.transform(p[0], p[1]) for p in cutline ]
+    return projected_corners, pixels, cutline_4326
+
+
+def run_batched(gcps, corners, cutline):
+    transformer = get_geodetic_transformer(CRS_PROJ)
+    projected_gcps = project_gcps(transformer, gcps)
+
+    proj_transformer = GCPBasedTransformer(projected_gcps)
+    projected_corners = pixels_to_coords(proj_transformer, corners)
+
+    gcp_transformer = GCPBasedTransformer(gcps)
+    pixels = coords_to_pixels(gcp_transformer, cutline[:-1])
+
+    datum_transformer = get_transformer('EPSG:4284', 'EPSG:4326')
+    cutline_4326 = transform_points(datum_transformer, cutline)
+    return projected_corners, pixels, cutline_4326
+
+
+def check_same(a, b):
+    for xs, ys in zip(a, b):
+        for p, q in zip(xs, ys):
+            if abs(p[0] - q[0]) > 1e-6 or abs(p[1] - q[1]) > 1e-6:
+                raise Exception(f'batched result {q} differs from {p}')
+
+
+def main():
+    num_sheets = int(sys.argv[1]) if len(sys.argv) > 1 else 1000
+    cutline_points = int(sys.argv[2]) if len(sys.argv) > 2 else 64
+
+    gcps, corners, cutline = get_sheet(cutline_points)
+    # also warms up the crs registry, so that only the transforms are timed
+    check_same(run_per_point(gcps, corners, cutline), run_batched(gcps, corners, cutline))
+
+    for name, fn in [('per point', run_per_point), ('batched', run_batched)]:
+        start = time.perf_counter()
+        for _ in range(num_sheets):
+            fn(gcps, corners, cutline)
+        elapsed = time.perf_counter() - start
+        print(f'{name}: {elapsed:.2f} secs for {num_sheets} sheets, {elapsed * 1e6 / num_sheets:.0f} us per sheet')
+
+
+if __name__ == '__main__':
+    main()
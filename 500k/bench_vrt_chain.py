@@ -0,0 +1,108 @@
+# /// script
+# requires-python = ">=3.12"
+# dependencies = [
+#     "topo-map-processor[parse]",
+#     "ozi-map",
+#     "geojson-rewind",
+# ]
+#
+# [tool.uv.sources]
+# ozi-map = { git = "https://github.com/wladich/ozi_map.git" }
+# topo-map-processor = { path = "../../topo_map_processor", editable = true }
+# ///
+
+# compares the georef.tif -> warped.tif -> final.tif pipeline with the vrt chain for a few sheets
+# usage: uv run bench_vrt_chain.py mapstor/data/raw/<sheet>.gif [...]
+
+import os
+import sys
+import json
+import time
+import shutil
+import resource
+from pathlib import Path
+
+from parse_mapstor import GSMapstorProcessor, get_sheetmap
+
+
+class BenchProcessor(GSMapstorProcessor):
+    def __init__(self, filepath, extra, index_box, index_properties, inter_dir):
+        super().__init__(filepath, extra, index_box, index_properties)
+        self.inter_dir = inter_dir
+
+    def get_inter_dir(self):
+        return self.inter_dir
+
+
+def get_child_io():
+    # blocks read/written by the gdal subprocesses
+    usage = resource.getrusage(resource.RUSAGE_CHILDREN)
+    return usage.ru_inblock, usage.ru_oublock
+
+
+def run(filepath, extra, sheet_props, use_vrt_chain):
+    mode = 'vrt' if use_vrt_chain else 'gtiff'
+    inter_dir = Path('data/bench') / mode
+
+    processor = BenchProcessor(filepath, extra, [], dict(sheet_props), inter_dir)
+    processor.use_vrt_chain = use_vrt_chain
+
+    # shared by both modes, so not part of the measurement
+    processor.rotate()
+
+    in_start, out_start = get_child_io()
+    start = time.time()
+    processor.georeference()
+    processor.warp()
+    end = time.time()
+    in_end, out_end = get_child_io()
+
+    workdir = processor.get_workdir()
+    sizes = { f.name: f.stat().st_size for f in workdir.iterdir() if f.name != 'full.jpg' }
+    shutil.rmtree(inter_dir, ignore_errors=True)
+
+    return {
+        'time': end - start,
+        'read_blocks': in_end - in_start,
+        'written_blocks': out_end - out_start,
+        'bytes_on_disk': sum(sizes.values()),
+        'files': sizes,
+    }
+
+
+def main():
+    if len(sys.argv) < 2:
+        print("Usage: uv run bench_vrt_chain.py <image_file> [<image_file> ...]")
+        sys.exit(1)
+
+    special_cases_file = Path(__file__).parent / 'mapstor' / 'special_cases.json'
+    special_cases = {}
+    if special_cases_file.exists():
+        special_cases = json.loads(special_cases_file.read_text())
+
+    sheet_map = get_sheetmap()
+
+    for fname in sys.argv[1:]:
+        filepath = Path(fname)
+        id = filepath.name.replace(filepath.suffix, '')
+        extra = special_cases.get(filepath.name, {})
+        # only the first part of split sheets
+        extra = extra.get('parts', [extra])[0]
+        sheet_props = sheet_map[id]
+
+        gtiff = run(filepath, extra, sheet_props, False)
+        vrt = run(filepath, extra, sheet_props, True)
+
+        print(f'========== {id} ==========')
+        for mode, res in [('gtiff', gtiff), ('vrt', vrt)]:
+            print(f'{mode:>6}: {res["time"]:8.2f} secs, {res["bytes_on_disk"]:>12} bytes on disk, '
+                  f'{res["read_blocks"]:>10} blocks read, {res["written_blocks"]:>10} blocks written')
+            for name, size in res['files'].items():
+                print(f'{"":>8}{name}: {size}')
+        print(f' saved: {gtiff["time"] - vrt["time"]:8.2f} secs, {gtiff["bytes_on_disk"] - vrt["bytes_on_disk"]:>12} bytes, '
+              f'{gtiff["written_blocks"] - vrt["written_blocks"]:>10} blocks written')
+
+
+if __name__ == "__main__":
+    os.environ['GDAL_PAM_ENABLED'] = 'NO'
+    main()
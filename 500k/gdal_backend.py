@@ -0,0 +1,81 @@
+import time
+import shlex
+
+gdal = None
+
+
+def get_gdal():
+    # the gdal python bindings have to match the installed gdal, so they are only needed for this backend
+    global gdal
+    if gdal is None:
+        try:
+            from osgeo import gdal as _gdal
+        except ImportError as ex:
+            raise ImportError('the osgeo gdal bindings are not installed, they are not part of the script dependencies, '
+                              'run with `uv run --with gdal==$(gdal-config --version)`') from ex
+        _gdal.UseExceptions()
+        gdal = _gdal
+    return gdal
+
+
+def split_config_options(args):
+    config = {}
+    rest = []
+    i = 0
+    while i < len(args):
+        if args[i] == '--config':
+            config[args[i + 1]] = args[i + 2]
+            i += 3
+        else:
+            rest.append(args[i])
+            i += 1
+    return config, rest
+
+
+def run_in_process(cmd):
+    """
+    Runs a gdal_translate/gdalwarp/ogr2ogr command line through the osgeo.gdal api
+    in the current process, avoiding the process startup, driver registration and
+    proj db load of the external commands. The option parsing is gdal's own, so
+    the outputs are the same as running the command.
+    """
+    gdal = get_gdal()
+
+    print(f'running in process - {cmd}')
+    start = time.time()
+
+    args = shlex.split(cmd)
+    program = args[0]
+    config, args = split_config_options(args[1:])
+    # all the commands in the processors end with the input and output files
+    options = args[:-2]
+    first, second = args[-2:]
+
+    # the block cache size is process wide, it is put back after the command like the other config options
+    cache_max = config.pop('GDAL_CACHEMAX', None)
+    old_cache_max = gdal.GetCacheMax()
+    if cache_max is not None:
+        gdal.SetCacheMax(int(cache_max) * 1024 * 1024)
+
+    try:
+        with gdal.config_options(config):
+            if program == 'gdal_translate':
+                ds = gdal.Translate(second, first, options=options)
+            elif program == 'gdalwarp':
+                ds = gdal.Warp(second, first, options=options)
+            elif program == 'ogr2ogr':
+                # ogr2ogr takes the destination first
+                ds = gdal.VectorTranslate(first, second, options=options)
+            else:
+                raise ValueError(f'no in process equivalent for {program}')
+
+            if ds is None:
+                raise Exception(f'command {cmd} failed')
+            # closing the dataset flushes it to disk
+            ds = None
+    finally:
+        if cache_max is not None:
+            gdal.SetCacheMax(old_cache_max)
+
+    end = time.time()
+    print(f'command took {end - start} secs to run')
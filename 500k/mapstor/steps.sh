@@ -20,7 +20,12 @@ uv run filter_files.py
 # 6. download the files by reading the zip files remotely
 uv run download_files.py
 
-# 7. collect the sheet ids for th sheet map
-cat data/sheet_map.json| jq -r '. | keys[]' | sort > data/sheet_ids.txt
+# 7. the sheet ids for the sheet map are written to data/sheet_ids.txt by filter_files.py
+
+# to pick up later changes in the collection, relist from scratch, unchanged zips come from the listing cache
+# rm data/zip_files.csv && uv run list_zip_contents.py --refresh data/zip_urls.txt data/zip_files.csv
+# uv run filter_files.py --incremental
+# uv run download_files.py --changes data/sheet_changes.json
+# and reprocess the changed sheets with FROM_LIST=mapstor/data/changed_files.txt
 
 
@@ -0,0 +1,99 @@
+import re
+import csv
+import json
+from pathlib import Path
+
+import filter_files
+
+
+def baseline_sheet_map(rows):
+    """
+    The selection of the original filter_files.py, before it was made to stream the csv,
+    with the year comparison applied to every listed gif.
+    """
+    by_id = {}
+    for url, fname in rows:
+        if filter_files.should_skip(fname) or not fname.endswith('.gif'):
+            continue
+        gif_filename = Path(fname).name
+        parts = gif_filename.removesuffix('.gif').split('--') + Path(url).stem.split('--')
+
+        ids = []
+        year = None
+        for part in parts:
+            if not year:
+                year = filter_files.extract_year(part)
+            for full_match in re.finditer(r'[a-zA-Z]{1,2}\d{2}-[\d_]+', part):
+                match = re.match(r'([a-zA-Z]{1,2}\d{2}-)', full_match.group(0))
+                if match:
+                    prefix = match.group(1).upper()
+                    for num_str in part[len(prefix):].split('_'):
+                        if num_str.isdigit() and f'{prefix}{num_str}' not in ids:
+                            ids.append(f'{prefix}{num_str}')
+        if not ids or not year:
+            continue
+
+        year_parts = year.split('-')
+        if len(year_parts) == 2 and year_parts[0] == year_parts[-1]:
+            year = year_parts[0]
+        year_for_comparison = int(year.split('-')[0])
+
+        map_id = '_'.join(sorted(ids))
+        if map_id in by_id and int(by_id[map_id]['year'].split('-')[0]) >= year_for_comparison:
+            continue
+        by_id[map_id] = { 'url': url, 'year': year, 'filename': gif_filename, 'id': map_id }
+    return by_id
+
+
+def write_csv(csv_path, rows):
+    with open(csv_path, 'w', newline='') as f:
+        writer = csv.writer(f)
+        writer.writerow(['url', 'filename'])
+        for row in rows:
+            writer.writerow(row)
+
+
+def run_filter_files(tmp_path, rows):
+    csv_path = tmp_path / 'zip_files.csv'
+    out_path = tmp_path / 'sheet_map.json'
+    write_csv(csv_path, rows)
+    by_id = filter_files.filter_files(csv_path)
+    sheet_map = { map_id: filter_files.get_entry(map_id, best) for map_id, best in by_id.items() }
+    filter_files.write_sheet_map(sheet_map, out_path)
+    return json.loads(out_path.read_text())
+
+
+ZIP_1975 = 'https://archive.org/download/gs--500k--k35/k35--gs--500k--_1975-1975_.zip'
+ZIP_1956 = 'https://archive.org/download/gs--500k--k35/k35--gs--500k--_1956-1959_.zip'
+
+EDITION_ROWS = [
+    (ZIP_1975, 'maps/'),
+    (ZIP_1975, 'maps/k35-003--gs--500k.gif'),
+    (ZIP_1975, 'maps/k35-003--gs--500k.map'),
+    (ZIP_1975, 'maps/k35-004--gs--500k--(1980).gif'),
+    (ZIP_1956, 'maps/'),
+    (ZIP_1956, 'maps/k35-003--gs--500k.gif'),
+    (ZIP_1956, 'maps/k35-003--gs--500k.map'),
+    (ZIP_1956, 'maps/k35-004--gs--500k--(1957).gif'),
+    (ZIP_1956, 'maps/k35-005--gs--500k.gif'),
+]
+
+
+def test_same_member_in_edition_zips(tmp_path):
+    for rows in [EDITION_ROWS, EDITION_ROWS[4:] + EDITION_ROWS[:4]]:
+        sheet_map = run_filter_files(tmp_path, rows)
+        assert sheet_map == baseline_sheet_map(rows)
+        # the newer edition wins whichever zip is listed first
+        assert sheet_map['K35-003']['year'] == '1975'
+        assert sheet_map['K35-003']['url'] == ZIP_1975
+        assert sheet_map['K35-004']['year'] == '1980'
+        assert sheet_map['K35-005']['year'] == '1956-1959'
+
+
+def test_same_year_keeps_first_listing(tmp_path):
+    zip_a = 'https://archive.org/download/a/k35--gs--500k--_1975-1975_.zip'
+    zip_b = 'https://archive.org/download/b/k35--gs--500k--_1975-1975_.zip'
+    rows = [(zip_a, 'maps/k35-003--gs--500k.gif'), (zip_b, 'maps/k35-003--gs--500k.gif')]
+    sheet_map = run_filter_files(tmp_path, rows)
+    assert sheet_map == baseline_sheet_map(rows)
+    assert sheet_map['K35-003']['url'] == zip_a
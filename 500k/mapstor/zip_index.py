@@ -0,0 +1,108 @@
+import json
+import hashlib
+from pathlib import Path
+
+CACHE_DIR = Path('data/zip_index')
+
+
+class ZipChangedError(Exception):
+    pass
+
+
+def get_cache_file(url, cache_dir=CACHE_DIR):
+    return Path(cache_dir) / (hashlib.sha1(url.encode('utf-8')).hexdigest() + '.json')
+
+
+def get_etag(session, url):
+    resp = session.head(url, allow_redirects=True, timeout=60)
+    resp.raise_for_status()
+    return resp.headers.get('ETag')
+
+
+def get_if_range_headers(listing):
+    # only a strong etag can be used to make the server refuse ranges of a changed archive
+    etag = listing.get('etag')
+    if etag is None or etag.startswith('W/'):
+        return {}
+    return { 'If-Range': etag }
+
+
+def read_central_directory(session, url):
+    # only needed when a listing is not in the cache
+    import remotezip
+
+    with remotezip.RemoteZip(url, session=session) as zip_file:
+        members = []
+        for info in zip_file.infolist():
+            members.append({
+                'name': info.filename,
+                'header_offset': info.header_offset,
+                'compress_size': info.compress_size,
+                'file_size': info.file_size,
+                'crc': info.CRC,
+                'compress_type': info.compress_type,
+            })
+        return { 'start_dir': zip_file.start_dir, 'members': members }
+
+
+def load_cached_listing(url, cache_dir=CACHE_DIR):
+    cache_file = get_cache_file(url, cache_dir)
+    if not cache_file.exists():
+        return None
+    return json.loads(cache_file.read_text())
+
+
+def get_member_spans(listing, names):
+    # a member's local header and data run up to the next member's local header
+    members = sorted(listing['members'], key=lambda m: m['header_offset'])
+    spans = {}
+    for i, member in enumerate(members):
+        if member['name'] not in names:
+            continue
+        end = members[i + 1]['header_offset'] if i + 1 < len(members) else listing['start_dir']
+        spans[member['name']] = (member['header_offset'], end)
+    return spans
+
+
+class ZipIndex:
+    """
+    Per url cache of the central directory of remote zips, so that member ranges are known without
+    touching the end of the archive again. Cached listings are used as is, unless refresh is set,
+    in which case the etag is checked and the directory is only reread if it changed.
+    """
+    def __init__(self, session, cache_dir=CACHE_DIR, refresh=False):
+        self.session = session
+        self.cache_dir = Path(cache_dir)
+        self.refresh = refresh
+        self.hits = 0
+        self.misses = 0
+
+    def load(self, url):
+        return load_cached_listing(url, self.cache_dir)
+
+    def save(self, listing):
+        self.cache_dir.mkdir(parents=True, exist_ok=True)
+        cache_file = get_cache_file(listing['url'], self.cache_dir)
+        tmp_file = cache_file.with_suffix('.json.tmp')
+        tmp_file.write_text(json.dumps(listing))
+        tmp_file.replace(cache_file)
+
+    def invalidate(self, url):
+        get_cache_file(url, self.cache_dir).unlink(missing_ok=True)
+
+    def get(self, url):
+        listing = self.load(url)
+        if listing is not None and not self.refresh:
+            self.hits += 1
+            return listing
+
+        etag = get_etag(self.session, url)
+        if listing is not None and etag is not None and listing['etag'] == etag:
+            self.hits += 1
+            return listing
+
+        self.misses += 1
+        listing = { 'url': url, 'etag': etag }
+        listing.update(read_central_directory(self.session, url))
+        self.save(listing)
+        return listing
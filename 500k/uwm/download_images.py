@@ -1,7 +1,25 @@
+# /// script
+# requires-python = ">=3.12"
+# dependencies = [
+#     "requests",
+#     "pillow",
+# ]
+# ///
 
 import json
 import os
+import time
+import shutil
+import argparse
 import requests
+from pathlib import Path
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from requests.adapters import HTTPAdapter
+from PIL import Image
+
+Image.MAX_IMAGE_PIXELS = None
+
+DEFAULT_TILE_SIZE = 1024
 
 def download_images():
     # Create the output directory if it doesn't exist
@@ -33,5 +51,166 @@ def download_images():
         except requests.exceptions.RequestException as e:
             print(f'Failed to download {id}: {e}')
 
+
+def get_session(workers):
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=4, pool_maxsize=workers)
+    session.mount('https://', adapter)
+    session.mount('http://', adapter)
+    return session
+
+
+def get_image_service(url):
+    # strip the {region}/{size}/{rotation}/{quality}.{format} of the full image url
+    return url.rsplit('/', 4)[0]
+
+
+def get_with_retries(session, url, retries=3):
+    for attempt in range(retries + 1):
+        try:
+            resp = session.get(url, timeout=120)
+            resp.raise_for_status()
+            return resp
+        except requests.exceptions.RequestException:
+            if attempt == retries:
+                raise
+            time.sleep(2 ** attempt)
+
+
+def get_image_info(session, service):
+    return get_with_retries(session, f'{service}/info.json').json()
+
+
+def get_regions(info, tile_size=None):
+    if tile_size is None:
+        tiles = info.get('tiles', [])
+        tile_size = tiles[0]['width'] if tiles else DEFAULT_TILE_SIZE
+    width, height = info['width'], info['height']
+    regions = []
+    for y in range(0, height, tile_size):
+        for x in range(0, width, tile_size):
+            regions.append((x, y, min(tile_size, width - x), min(tile_size, height - y)))
+    return regions
+
+
+def get_region_url(service, info, region):
+    # full size is spelt 'max' from iiif image api 3 onwards
+    context = info.get('@context', '')
+    size = 'max' if 'image/3' in json.dumps(context) else 'full'
+    x, y, w, h = region
+    return f'{service}/{x},{y},{w},{h}/{size}/0/default.jpg'
+
+
+def get_tile_path(tile_dir, region):
+    x, y, w, h = region
+    return tile_dir / f'{x}_{y}_{w}_{h}.jpg'
+
+
+def fetch_tile(session, url, tile_path):
+    resp = get_with_retries(session, url)
+    part_path = tile_path.with_name(tile_path.name + '.part')
+    part_path.write_bytes(resp.content)
+    os.replace(part_path, tile_path)
+    return len(resp.content)
+
+
+def stitch(info, regions, tile_dir, out_path):
+    # the tiles are decoded and pasted as is, and written out without any lossy re-encode
+    canvas = Image.new('RGB', (info['width'], info['height']))
+    for region in regions:
+        x, y, w, h = region
+        tile = Image.open(get_tile_path(tile_dir, region))
+        if tile.size != (w, h):
+            raise Exception(f'tile {region} came back with size {tile.size}')
+        canvas.paste(tile.convert('RGB'), (x, y))
+    part_path = out_path.with_name(out_path.name + '.part')
+    canvas.save(part_path, format='TIFF', compression='tiff_deflate')
+    os.replace(part_path, out_path)
+    shutil.rmtree(tile_dir)
+
+
+def download_images_tiled(workers, tile_size=None):
+    output_dir = Path('data/raw')
+    tiles_dir = Path('data/tiles')
+    output_dir.mkdir(parents=True, exist_ok=True)
+
+    data = json.loads(Path('info.json').read_text())
+
+    ids = []
+    for id in data.keys():
+        if output_dir.joinpath(f'{id}.jpg').exists() or output_dir.joinpath(f'{id}.tif').exists():
+            print(f'Skipping {id}, file already exists.')
+            continue
+        ids.append(id)
+
+    session = get_session(workers)
+    sheets = {}
+    failed = set()
+    done_count = 0
+    total_bytes = 0
+    start = time.time()
+    # every image shares the one pool, so workers bounds the requests in flight across all of them
+    with ThreadPoolExecutor(workers) as executor:
+        kinds = {}
+        for id in ids:
+            service = get_image_service(data[id]['url'])
+            future = executor.submit(get_image_info, session, service)
+            kinds[future] = ('info', id)
+
+        pending = set(kinds.keys())
+        while pending:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                kind, id = kinds.pop(future)
+                try:
+                    result = future.result()
+                except Exception as e:
+                    print(f'Failed to download {kind} for {id}: {e}')
+                    failed.add(id)
+                    continue
+
+                if kind == 'info':
+                    service = get_image_service(data[id]['url'])
+                    regions = get_regions(result, tile_size)
+                    tile_dir = tiles_dir / id
+                    tile_dir.mkdir(parents=True, exist_ok=True)
+                    # tiles from an earlier interrupted run are reused
+                    todo = [ region for region in regions if not get_tile_path(tile_dir, region).exists() ]
+                    sheets[id] = { 'info': result, 'regions': regions, 'tile_dir': tile_dir, 'remaining': len(todo) }
+                    print(f'{id}: {result["width"]}x{result["height"]} in {len(regions)} tiles, {len(todo)} to fetch')
+                    for region in todo:
+                        url = get_region_url(service, result, region)
+                        tile_future = executor.submit(fetch_tile, session, url, get_tile_path(tile_dir, region))
+                        kinds[tile_future] = ('tile', id)
+                        pending.add(tile_future)
+                else:
+                    total_bytes += result
+                    sheets[id]['remaining'] -= 1
+
+                sheet = sheets[id]
+                if sheet['remaining'] == 0 and id not in failed:
+                    try:
+                        stitch(sheet['info'], sheet['regions'], sheet['tile_dir'], output_dir / f'{id}.tif')
+                        done_count += 1
+                        print(f'Successfully downloaded {id}.')
+                    except Exception as e:
+                        print(f'Failed to stitch {id}: {e}')
+                        failed.add(id)
+
+    elapsed = time.time() - start
+    print(f'{done_count} downloaded, {len(failed)} failed, {total_bytes / (1024 * 1024):.1f} MB of tiles in {elapsed:.1f} secs')
+    if failed:
+        print('rerun to resume the failed sheets: ' + ' '.join(sorted(failed)))
+
+
 if __name__ == '__main__':
-    download_images()
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--tiled', action='store_true', help='fetch iiif region tiles in parallel and stitch them into a tif, instead of the full image render')
+    parser.add_argument('--workers', type=int, default=16, help='max number of tile requests in flight across all the images')
+    parser.add_argument('--tile-size', type=int, default=None, help='region size to request, defaults to the tile size advertised by the server')
+    args = parser.parse_args()
+
+    if args.tiled:
+        download_images_tiled(args.workers, args.tile_size)
+    else:
+        download_images()
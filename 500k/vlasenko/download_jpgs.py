@@ -7,12 +7,16 @@
 # ///
 
 import os
+import json
+import time
+import argparse
 import re
-import sys
 import requests
 import shutil
 from bs4 import BeautifulSoup
 from pathlib import Path
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from requests.adapters import HTTPAdapter
 
 def transform_sheet_id(sheet_id_raw):
     """Transforms the raw sheet ID to the desired format."""
@@ -37,7 +41,84 @@ def transform_sheet_id(sheet_id_raw):
         return single_transform(sheet_id_raw)
 
 
-def download_jpgs(jpg_list_file, html_file, download_dir):
+def get_session(workers):
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=4, pool_maxsize=workers)
+    session.mount('https://', adapter)
+    session.mount('http://', adapter)
+    return session
+
+
+def download_file(session, url, target_path, validators):
+    """
+    Streams url to a .part file next to target_path and renames it into place when complete.
+    If target_path exists, the request is made conditional on the validators of the earlier download.
+    Returns the status, the number of bytes written and the validators of the response.
+    """
+    headers = {}
+    if target_path.exists() and validators:
+        if validators.get('etag'):
+            headers['If-None-Match'] = validators['etag']
+        if validators.get('last_modified'):
+            headers['If-Modified-Since'] = validators['last_modified']
+
+    part_path = target_path.with_name(target_path.name + '.part')
+    with session.get(url, headers=headers, stream=True, timeout=60) as resp:
+        if resp.status_code == 304:
+            return 'not_modified', 0, validators
+        resp.raise_for_status()
+        size = 0
+        try:
+            with open(part_path, 'wb') as f:
+                for chunk in resp.iter_content(1024 * 1024):
+                    f.write(chunk)
+                    size += len(chunk)
+            os.replace(part_path, target_path)
+        finally:
+            part_path.unlink(missing_ok=True)
+        new_validators = {
+            'etag': resp.headers.get('ETag'),
+            'last_modified': resp.headers.get('Last-Modified'),
+        }
+    return 'downloaded', size, new_validators
+
+
+def download_all(jobs, workers, state_file):
+    # etag/last-modified of every downloaded file, used to make refreshes conditional
+    state = json.loads(state_file.read_text()) if state_file.exists() else {}
+
+    session = get_session(workers)
+    counts = { 'downloaded': 0, 'not_modified': 0, 'failed': 0 }
+    total_bytes = 0
+    start = time.time()
+    with ThreadPoolExecutor(workers) as executor:
+        futures = {}
+        for sheet_id, url, target_path in jobs:
+            future = executor.submit(download_file, session, url, target_path, state.get(target_path.name))
+            futures[future] = (sheet_id, target_path)
+
+        for future in as_completed(futures):
+            sheet_id, target_path = futures[future]
+            try:
+                status, size, validators = future.result()
+            except Exception as e:
+                counts['failed'] += 1
+                print(f"Failed to retrieve {sheet_id}: {e}")
+                continue
+            counts[status] += 1
+            total_bytes += size
+            state[target_path.name] = validators
+            print(f"{sheet_id}: {status} {size} bytes")
+
+    state_file.write_text(json.dumps(state, indent=2, sort_keys=True))
+
+    elapsed = time.time() - start
+    rate = total_bytes / elapsed / (1024 * 1024) if elapsed > 0 else 0
+    print(f"{counts['downloaded']} downloaded, {counts['not_modified']} not modified, {counts['failed']} failed, "
+          f"{total_bytes / (1024 * 1024):.1f} MB in {elapsed:.1f} secs, {rate:.2f} MB/s")
+
+
+def download_jpgs(jpg_list_file, html_file, download_dir, workers=8, refresh=False):
     """
     Parses an HTML file to find and download GIF files listed in a text file.
 
@@ -45,6 +126,8 @@ def download_jpgs(jpg_list_file, html_file, download_dir):
         jpg_list_file (str): Path to the text file containing the list of GIF filenames.
         html_file (str): Path to the HTML file to parse for download links.
         download_dir (str): Directory to save the downloaded GIFs.
+        workers (int): Number of parallel downloads.
+        refresh (bool): Recheck already downloaded files with conditional requests.
     """
     if not os.path.exists(download_dir):
         os.makedirs(download_dir)
@@ -61,6 +144,9 @@ def download_jpgs(jpg_list_file, html_file, download_dir):
     
     base_url = "https://maps.vlasenko.net"
 
+    # keyed by target, the html can link a sheet more than once
+    jobs = {}
+
     for a_tag in soup.find_all('a'):
         if not a_tag['href'].lower().endswith('.jpg'):
             continue
@@ -77,24 +163,24 @@ def download_jpgs(jpg_list_file, html_file, download_dir):
             shutil.copy(source_map_file, Path(download_dir, f"{transformed_id}.map"))
 
         target_path = Path(download_dir, f"{transformed_id}.jpg")
-        if target_path.exists():
+        if target_path.exists() and not refresh:
             continue
 
-        print(transformed_id)
-        resp = requests.get(full_url)
-        if resp.status_code != 200:
-            print(f"Failed to retrieve page for {transformed_id}")
-            continue
-        target_path.write_bytes(resp.content)
+        jobs[target_path] = (transformed_id, full_url, target_path)
+
+    print(f"{len(jobs)} files to download")
+    download_all(list(jobs.values()), workers, Path(download_dir).parent / 'download_state.json')
 
 if __name__ == "__main__":
-    if len(sys.argv) != 2:
-        print("Usage: python download_jpgs.py <jpg_list_file>")
-        sys.exit(1)
+    parser = argparse.ArgumentParser(description='download the sheet jpgs listed in a file')
+    parser.add_argument('jpg_list_file', help='file with one sheet jpg name per line')
+    parser.add_argument('--workers', type=int, default=8, help='number of parallel downloads')
+    parser.add_argument('--refresh', action='store_true', help='recheck already downloaded files, only fetching the changed ones')
+    args = parser.parse_args()
 
-    jpg_list_file = sys.argv[1]
+    jpg_list_file = args.jpg_list_file
     html_file = 'data/map500k.html'
     download_dir = 'data/raw'
     
-    download_jpgs(jpg_list_file, html_file, download_dir)
+    download_jpgs(jpg_list_file, html_file, download_dir, workers=args.workers, refresh=args.refresh)
 
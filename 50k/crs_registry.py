@@ -0,0 +1,99 @@
+import numpy as np
+from pyproj import CRS, Transformer
+
+# there are only a few datums and gauss-kruger zones, so every crs and transformer
+# is built once per process and shared by all the sheets it handles
+_crs = {}
+_transformers = {}
+
+stats = {
+    'crs_hits': 0,
+    'crs_misses': 0,
+    'transformer_hits': 0,
+    'transformer_misses': 0,
+}
+
+
+def get_crs(crs_def):
+    crs = _crs.get(crs_def)
+    if crs is not None:
+        stats['crs_hits'] += 1
+        return crs
+    stats['crs_misses'] += 1
+    if crs_def.startswith('+'):
+        crs = CRS.from_proj4(crs_def)
+    else:
+        crs = CRS.from_user_input(crs_def)
+    _crs[crs_def] = crs
+    return crs
+
+
+def _get_transformer(key, make):
+    transformer = _transformers.get(key)
+    if transformer is not None:
+        stats['transformer_hits'] += 1
+        return transformer
+    stats['transformer_misses'] += 1
+    transformer = make()
+    _transformers[key] = transformer
+    return transformer
+
+
+def get_transformer(from_crs_def, to_crs_def):
+    return _get_transformer((from_crs_def, to_crs_def),
+                            lambda: Transformer.from_crs(get_crs(from_crs_def), get_crs(to_crs_def), always_xy=True))
+
+
+def get_geodetic_transformer(crs_def):
+    # lon/lat on the crs's own datum to the projected coordinates
+    def make():
+        crs = get_crs(crs_def)
+        return Transformer.from_crs(crs.geodetic_crs, crs, always_xy=True)
+    return _get_transformer(('geodetic', crs_def), make)
+
+
+
+# the batch helpers below make one call for all the points of a sheet, instead of one per point,
+# the per call overhead of proj and the tps transformer is much more than the per point cost
+
+def transform_points(transformer, points):
+    if len(points) == 0:
+        return []
+    arr = np.asarray(points, dtype=np.float64)
+    xs, ys = transformer.transform(arr[:, 0], arr[:, 1])
+    return list(zip(xs.tolist(), ys.tolist()))
+
+
+def project_gcps(transformer, gcps):
+    projected = transform_points(transformer, [gcp[1] for gcp in gcps])
+    return [(gcp[0], idx) for gcp, idx in zip(gcps, projected)]
+
+
+def coords_to_pixels(gcp_transformer, points):
+    # batched GCPBasedTransformer.rowcol(), points which are gcps map back to their exact pixels
+    pixels = [gcp_transformer.cooord_map.get((p[0], p[1])) for p in points]
+    todo = [ i for i, pixel in enumerate(pixels) if pixel is None ]
+    if todo:
+        arr = np.asarray([points[i] for i in todo], dtype=np.float64)
+        rs, cs = gcp_transformer.transformer.rowcol(arr[:, 0], arr[:, 1])
+        for i, r, c in zip(todo, np.asarray(rs).tolist(), np.asarray(cs).tolist()):
+            pixels[i] = (c, r)
+    return pixels
+
+
+def pixels_to_coords(gcp_transformer, pixels, offset='center'):
+    # batched GCPBasedTransformer.xy(), pixels are (x, y) like the gcp corners
+    coords = [gcp_transformer.pixel_map.get((p[1], p[0])) for p in pixels]
+    todo = [ i for i, coord in enumerate(coords) if coord is None ]
+    if todo:
+        arr = np.asarray([pixels[i] for i in todo], dtype=np.float64)
+        xs, ys = gcp_transformer.transformer.xy(arr[:, 1], arr[:, 0], offset=offset)
+        for i, x, y in zip(todo, np.asarray(xs).tolist(), np.asarray(ys).tolist()):
+            coords[i] = (x, y)
+    return coords
+
+
+def get_stats_str():
+    return ('crs cache: '
+            f'{stats["crs_hits"]} hits, {stats["crs_misses"]} misses, '
+            f'transformer cache: {stats["transformer_hits"]} hits, {stats["transformer_misses"]} misses')
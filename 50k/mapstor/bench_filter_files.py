@@ -0,0 +1,74 @@
+# times filter_files.py on a synthetic zip listing
+# usage: uv run bench_filter_files.py [num_rows]
+
+import io
+import sys
+import csv
+import time
+import random
+import resource
+import tempfile
+import contextlib
+from pathlib import Path
+
+import filter_files
+
+FILES_PER_ZIP = 500
+
+
+def write_synthetic_csv(csv_path, num_rows, seed=0):
+    rng = random.Random(seed)
+    with open(csv_path, 'w', newline='') as f:
+        writer = csv.writer(f)
+        writer.writerow(['url', 'filename'])
+        rows = 0
+        while rows < num_rows:
+            # a zip per 100k sheet, holding the 50k sheets of a few editions
+            letter = rng.choice('abcdefghijklmnopqr')
+            zone = rng.randint(30, 60)
+            num = rng.randint(1, 144)
+            start_year = rng.randint(1950, 1985)
+            end_year = start_year + rng.randint(0, 5)
+            sheet = f'{letter}{zone}-{num:03d}'
+            url = f'https://archive.org/download/gs--050k--{sheet}/{sheet}--gs--050k--_{start_year}-{end_year}_.zip'
+            writer.writerow([url, 'maps/'])
+            rows += 1
+            for i in range(FILES_PER_ZIP // 3):
+                year = rng.randint(start_year, end_year)
+                quarter = rng.choice('1234')
+                base = f'maps/{sheet}-{quarter}--gs--050k--({year})'
+                for fname in [f'{base}.gif', f'{base}.map', f'html/{sheet}-{quarter}-{i}.html']:
+                    writer.writerow([url, fname])
+                    rows += 1
+
+
+def main():
+    num_rows = int(sys.argv[1]) if len(sys.argv) > 1 else 1_000_000
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        csv_path = Path(tmp_dir) / 'zip_files.csv'
+        out_path = Path(tmp_dir) / 'sheet_map.json'
+
+        print(f'writing {num_rows} synthetic rows to {csv_path}')
+        write_synthetic_csv(csv_path, num_rows)
+        csv_size = csv_path.stat().st_size
+
+        start = time.time()
+        # the per file messages would dominate the timing
+        with contextlib.redirect_stdout(io.StringIO()):
+            by_id = filter_files.filter_files(csv_path)
+        filter_end = time.time()
+        sheet_map = { map_id: filter_files.get_entry(map_id, best) for map_id, best in by_id.items() }
+        filter_files.write_sheet_map(sheet_map, out_path)
+        end = time.time()
+
+        max_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        print(f'csv size: {csv_size / (1024 * 1024):.1f} MB')
+        print(f'filter: {filter_end - start:.2f} secs, {num_rows / (filter_end - start):.0f} rows/sec')
+        print(f'write: {end - filter_end:.2f} secs, {len(by_id)} ids, {out_path.stat().st_size} bytes')
+        print(f'part cache: {filter_files.parse_part.cache_info()}')
+        print(f'max rss: {max_rss / 1024:.1f} MB')
+
+
+if __name__ == '__main__':
+    main()
@@ -1,28 +1,48 @@
 import csv
 import os
 
-def check_map_files(csv_path):
-    gif_files = set()
-    map_files = set()
+from zip_index import load_cached_listing
 
+def get_filenames(csv_path):
+    # the zips are the ones in the csv, each is listed from its cached listing written by
+    # list_zip_contents.py/download_files.py when there is one, and from its csv rows otherwise
+    rows_by_url = {}
     with open(csv_path, 'r', encoding='utf-8') as f:
         reader = csv.reader(f)
         next(reader)  # Skip header
         for row in reader:
             if not row:
                 continue
-            filename = row[1]
-            if "mapstor" in filename or "coverage" in filename:
-                continue
-            if filename.endswith('.gif'):
-                base, _ = os.path.splitext(filename)
-                # The files are in "maps" and "html" directories, so we should only consider the filename itself
-                base = base.split('/')[-1]
-                gif_files.add(base)
-            elif filename.endswith('.map'):
-                base, _ = os.path.splitext(filename)
-                base = base.split('/')[-1]
-                map_files.add(base)
+            rows_by_url.setdefault(row[0], []).append(row[1])
+
+    uncached = 0
+    for url, filenames in rows_by_url.items():
+        listing = load_cached_listing(url)
+        if listing is None:
+            uncached += 1
+            yield from filenames
+            continue
+        for member in listing['members']:
+            yield member['name']
+    if uncached:
+        print(f"{uncached} of {len(rows_by_url)} zips have no cached listing, their csv rows were used")
+
+def check_map_files(csv_path):
+    gif_files = set()
+    map_files = set()
+
+    for filename in get_filenames(csv_path):
+        if "mapstor" in filename or "coverage" in filename:
+            continue
+        if filename.endswith('.gif'):
+            base, _ = os.path.splitext(filename)
+            # The files are in "maps" and "html" directories, so we should only consider the filename itself
+            base = base.split('/')[-1]
+            gif_files.add(base)
+        elif filename.endswith('.map'):
+            base, _ = os.path.splitext(filename)
+            base = base.split('/')[-1]
+            map_files.add(base)
 
     missing_maps = gif_files - map_files
     if not missing_maps:
@@ -2,12 +2,33 @@
 # requires-python = ">=3.12"
 # dependencies = [
 #     "remotezip",
+#     "requests",
 # ]
 # ///
 
+import os
 import json
-import remotezip
+import zlib
+import struct
+import zipfile
+import argparse
+import threading
+import requests
 from pathlib import Path
+from urllib.parse import urlparse
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from requests.adapters import HTTPAdapter
+
+from zip_index import ZipIndex, ZipChangedError, get_member_spans, get_if_range_headers
+
+# wanted members closer than this are fetched in one range request, along with whatever lies between them
+MAX_GAP = 1024 * 1024
+
+CHUNK_SIZE = 1024 * 1024
+
+LOCAL_HEADER_FORMAT = '<4s2B4HL2L2H'
+LOCAL_HEADER_SIZE = struct.calcsize(LOCAL_HEADER_FORMAT)
+LOCAL_HEADER_SIGNATURE = b'PK\003\004'
 
 def replace_fname(content, fname, replacement):
     txt = content.decode('cp1251')
@@ -15,49 +36,273 @@ def replace_fname(content, fname, replacement):
     return txt.encode('cp1251')
 
 
-def main():
-    data = json.loads(Path('data/sheet_map.json').read_text())
+def get_part_path(output_path):
+    # holds the raw zip span of the member until it is complete
+    return output_path.with_name(output_path.name + '.part')
+
+
+def get_tmp_path(output_path):
+    return output_path.with_name(output_path.name + '.tmp')
+
+
+def get_wanted_by_url(data, only_ids=None, replace_ids=frozenset()):
+    by_url = {}
     for k, item in data.items():
+        if only_ids is not None and k not in only_ids:
+            continue
         url = item.get('url')
         if not url:
             continue
         gif_fname = item.get('filename')
         map_fname = gif_fname.replace('.gif', '.map')
+        for fname, is_map in [(gif_fname, False), (map_fname, True)]:
+            output_path = Path('data/raw') / (f'{k}.map' if is_map else f'{k}.gif')
+            # replaced sheets are downloaded again and swapped in over the old files
+            if output_path.exists() and k not in replace_ids:
+                print(f"Skipping {fname} from {url}, already exists at {output_path}")
+                continue
+            by_url.setdefault(url, []).append({
+                'id': k,
+                'fname': fname,
+                'gif_fname': gif_fname,
+                'member': f"maps/{fname}",
+                'is_map': is_map,
+                'output_path': output_path,
+            })
+    return by_url
 
-        out_gif_path = Path('data/raw') / f'{k}.gif'
-        out_map_path = Path('data/raw') / f'{k}.map'
 
-        if out_gif_path.exists() and out_map_path.exists():
-            print(f"Skipping {k} from {url}, all files already exist.")
-            continue
+def coalesce_spans(spans, max_gap=MAX_GAP):
+    groups = []
+    for member, (start, end) in sorted(spans.items(), key=lambda x: x[1][0]):
+        if groups and start - groups[-1]['end'] <= max_gap:
+            groups[-1]['end'] = max(groups[-1]['end'], end)
+            groups[-1]['members'].append(member)
+        else:
+            groups.append({ 'start': start, 'end': end, 'members': [member] })
+    return groups
+
+
+class HostLimits:
+    def __init__(self, urls, per_host):
+        self.semaphores = { urlparse(url).netloc: threading.BoundedSemaphore(per_host) for url in urls }
+
+    def get(self, url):
+        return self.semaphores[urlparse(url).netloc]
+
+
+def get_session(workers):
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=16, pool_maxsize=workers)
+    session.mount('https://', adapter)
+    session.mount('http://', adapter)
+    return session
+
+
+def inflate_part(part_path, member, tmp_path):
+    crc = 0
+    with open(part_path, 'rb') as f_in, open(tmp_path, 'wb') as f_out:
+        header = struct.unpack(LOCAL_HEADER_FORMAT, f_in.read(LOCAL_HEADER_SIZE))
+        if header[0] != LOCAL_HEADER_SIGNATURE:
+            raise Exception(f"bad local header for {member['name']}")
+        fname_len, extra_len = header[10], header[11]
+        f_in.seek(LOCAL_HEADER_SIZE + fname_len + extra_len)
+
+        if member['compress_type'] == zipfile.ZIP_STORED:
+            decompressor = None
+        elif member['compress_type'] == zipfile.ZIP_DEFLATED:
+            decompressor = zlib.decompressobj(-15)
+        else:
+            raise Exception(f"unsupported compression {member['compress_type']} for {member['name']}")
+
+        remaining = member['compress_size']
+        while remaining > 0:
+            data = f_in.read(min(CHUNK_SIZE, remaining))
+            if not data:
+                raise Exception(f'{part_path} is short')
+            remaining -= len(data)
+            if decompressor is not None:
+                data = decompressor.decompress(data)
+            crc = zlib.crc32(data, crc)
+            f_out.write(data)
+        if decompressor is not None:
+            data = decompressor.flush()
+            crc = zlib.crc32(data, crc)
+            f_out.write(data)
+
+    if crc != member['crc']:
+        raise Exception(f"crc mismatch for {member['name']}")
+
 
+def finalize_item(item, member, url):
+    output_path = item['output_path']
+    part_path = get_part_path(output_path)
+    tmp_path = get_tmp_path(output_path)
+    try:
+        inflate_part(part_path, member, tmp_path)
+        if item['is_map']:
+            content = replace_fname(tmp_path.read_bytes(), item['gif_fname'], f"{item['id']}.gif")
+            tmp_path.write_bytes(content)
+        # only complete and verified files ever show up under their final name
+        os.replace(tmp_path, output_path)
+        print(f"Downloaded {item['fname']} from {url} to {output_path}")
+    finally:
+        # a complete span which fails to inflate can't be resumed either, so start over on the next run
+        part_path.unlink(missing_ok=True)
+        tmp_path.unlink(missing_ok=True)
+
+
+def stream_to_parts(session, listing, start, end, parts):
+    url = listing['url']
+    headers = { 'Range': f'bytes={start}-{end - 1}' }
+    headers.update(get_if_range_headers(listing))
+    resp = session.get(url, headers=headers, stream=True, timeout=60)
+    try:
+        resp.raise_for_status()
+        if resp.status_code == 200 and 'If-Range' in headers:
+            raise ZipChangedError(f'{url} changed since its listing was cached')
+        if resp.status_code != 206:
+            raise Exception(f'range request not honoured by {url}, got status {resp.status_code}')
+
+        files = {}
         try:
-            with remotezip.RemoteZip(url) as zip_file:
-                files_to_process = [
-                    (gif_fname, out_gif_path, False),
-                    (map_fname, out_map_path, True)
-                ]
-                # extract just fname file from archive
-                for fname, output_path, is_map in files_to_process:
-                    if output_path.exists():
-                        print(f"Skipping {fname} from {url}, already exists at {output_path}")
+            for part in parts:
+                files[part['path']] = open(part['path'], 'ab')
+            pos = start
+            for chunk in resp.iter_content(CHUNK_SIZE):
+                chunk_end = pos + len(chunk)
+                for part in parts:
+                    # bytes between the parts belong to members which are not wanted or already downloaded
+                    if part['start'] >= chunk_end or part['end'] <= pos:
                         continue
+                    s = max(part['start'], pos) - pos
+                    e = min(part['end'], chunk_end) - pos
+                    files[part['path']].write(chunk[s:e])
+                pos = chunk_end
+        finally:
+            for f in files.values():
+                f.close()
+    finally:
+        resp.close()
 
-                    fname_full = f"maps/{fname}"
-                    if fname_full in zip_file.namelist():
-                        with zip_file.open(fname_full) as file:
-                            content = file.read()
-                            # Save the content to a local file
-                            output_path.parent.mkdir(parents=True, exist_ok=True)
-                            if is_map:
-                                content = replace_fname(content, gif_fname, f'{k}.gif')
-                            output_path.write_bytes(content)
-                            print(f"Downloaded {fname} from {url} to {output_path}")
-                    else:
-                        print(f"{fname} not found in {url}")
+
+def download_group(session, zip_index, limits, listing, group, items_by_member):
+    url = listing['url']
+    members = { member['name']: member for member in listing['members'] }
+    parts = []
+    for member in group['members']:
+        span_start, span_end = group['spans'][member]
+        for item in items_by_member[member]:
+            part_path = get_part_path(item['output_path'])
+            done = part_path.stat().st_size if part_path.exists() else 0
+            if done > span_end - span_start:
+                part_path.unlink()
+                done = 0
+            parts.append({ 'path': part_path, 'start': span_start + done, 'end': span_end, 'item': item, 'member': member })
+
+    pending = [ part for part in parts if part['start'] < part['end'] ]
+    if pending:
+        start = min(part['start'] for part in pending)
+        end = max(part['end'] for part in pending)
+        resumed = sum(1 for part in pending if part['start'] != group['spans'][part['member']][0])
+        print(f"Fetching bytes {start}-{end} for {len(pending)} members from {url}, {resumed} resumed")
+        for part in pending:
+            part['path'].parent.mkdir(parents=True, exist_ok=True)
+        try:
+            with limits.get(url):
+                stream_to_parts(session, listing, start, end, pending)
+        except ZipChangedError:
+            # the cached offsets and the partial spans are of the old archive
+            zip_index.invalidate(url)
+            for part in parts:
+                part['path'].unlink(missing_ok=True)
+            raise
+
+    failed = 0
+    for part in parts:
+        span_start, span_end = group['spans'][part['member']]
+        if part['path'].stat().st_size != span_end - span_start:
+            failed += 1
+            print(f"Incomplete {part['item']['fname']} from {url}, rerun to resume it")
+            continue
+        try:
+            finalize_item(part['item'], members[part['member']], url)
         except Exception as e:
-            print(f"Error processing {k} from {url}: {e}")
+            failed += 1
+            print(f"Error processing {part['item']['fname']} from {url}: {e}")
+    return failed
+
+
+def plan_zip(zip_index, limits, url, items):
+    with limits.get(url):
+        listing = zip_index.get(url)
+
+    names = set(member['name'] for member in listing['members'])
+    items_by_member = {}
+    for item in items:
+        if item['member'] not in names:
+            print(f"{item['fname']} not found in {url}")
+            continue
+        items_by_member.setdefault(item['member'], []).append(item)
+    spans = get_member_spans(listing, set(items_by_member.keys()))
+
+    groups = coalesce_spans(spans)
+    for group in groups:
+        group['spans'] = { member: spans[member] for member in group['members'] }
+    return listing, items_by_member, groups
+
+
+def main():
+    parser = argparse.ArgumentParser(description='download the sheet .gif/.map files out of the remote zips')
+    parser.add_argument('--workers', type=int, default=8, help='total number of parallel requests')
+    parser.add_argument('--per-host', type=int, default=4, help='max number of parallel requests to a single host')
+    parser.add_argument('--refresh', action='store_true', help='check the etags of cached zip listings and reread the changed ones')
+    parser.add_argument('--changes', help='changeset from filter_files.py, only download its added and replaced sheets')
+    args = parser.parse_args()
+
+    data = json.loads(Path('data/sheet_map.json').read_text())
+    only_ids = None
+    replace_ids = frozenset()
+    if args.changes is not None:
+        changes = json.loads(Path(args.changes).read_text())
+        only_ids = set(changes['added']) | set(changes['replaced'])
+        replace_ids = frozenset(changes['replaced'])
+        if changes['removed']:
+            print(f"{len(changes['removed'])} sheets are no longer in the listing, their files are left alone: {' '.join(changes['removed'])}")
+    by_url = get_wanted_by_url(data, only_ids, replace_ids)
+    print(f"{sum(len(items) for items in by_url.values())} files to download from {len(by_url)} zips")
+
+    session = get_session(args.workers)
+    zip_index = ZipIndex(session, refresh=args.refresh)
+    limits = HostLimits(by_url.keys(), args.per_host)
+    failed = 0
+    with ThreadPoolExecutor(args.workers) as executor:
+        plans = { executor.submit(plan_zip, zip_index, limits, url, items): url for url, items in by_url.items() }
+        downloads = {}
+        for future in as_completed(plans):
+            url = plans[future]
+            try:
+                listing, items_by_member, groups = future.result()
+            except Exception as e:
+                failed += len(by_url[url])
+                print(f"Error processing {url}: {e}")
+                continue
+            print(f"Fetching {sum(len(g['members']) for g in groups)} members from {url} in {len(groups)} requests")
+            for group in groups:
+                future = executor.submit(download_group, session, zip_index, limits, listing, group, items_by_member)
+                downloads[future] = url
+
+        for future in as_completed(downloads):
+            url = downloads[future]
+            try:
+                failed += future.result()
+            except Exception as e:
+                print(f"Error processing {url}: {e}")
+                failed += 1
+
+    print(f"zip listings: {zip_index.hits} from cache, {zip_index.misses} fetched")
+    print(f"Done, {failed} failures, rerun to resume them")
 
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    main()
@@ -1,66 +1,88 @@
-import os
-import subprocess
-import shutil
+import argparse
+from pathlib import Path
 
-def tile_tiffs():
-    gtiffs_dir = 'data/25k/export/gtiffs'
-    temp_dir = 'temp'
-    tiles_dir = 'temp_tiles'
+from tiler import (
+    DirTileSink, PMTilesSink, PMTilesUpdateSink, SUPPORTED_FORMATS,
+    get_metadata, get_pmtiles_header, get_tile_format, tile_tiffs, retile_sheets,
+)
 
 
-    tiffs = [f for f in os.listdir(gtiffs_dir) if f.endswith('.tif')]
-    total_tiffs = len(tiffs)
-    successful_count = 0
-    failed_sheets = []
+def get_changed_ids(args):
+    changed_ids = list(args.changed_ids or [])
+    if args.changed_ids_file is not None:
+        for line in Path(args.changed_ids_file).read_text().split('\n'):
+            line = line.strip()
+            if line == '' or line.startswith('#'):
+                continue
+            changed_ids.append(line)
+    return changed_ids
 
-    for i, tiff_file in enumerate(tiffs):
-        sheet_no = os.path.splitext(tiff_file)[0]
-        sheet_temp_dir = os.path.join(temp_dir, sheet_no)
 
-        if not os.path.exists(temp_dir):
-            os.makedirs(temp_dir)
+def main():
+    parser = argparse.ArgumentParser(description='tile all the sheet gtiffs in one pass over a process pool')
+    parser.add_argument('--gtiffs-dir', default='data/25k/export/gtiffs', help='directory with the exported sheet gtiffs')
+    parser.add_argument('--tiles-dir', default='temp_tiles', help='directory the z/x/y tiles are written to')
+    parser.add_argument('--min-zoom', type=int, default=None, help='defaults to 15, or to the min zoom of the archive with --pmtiles')
+    parser.add_argument('--max-zoom', type=int, default=None, help='defaults to 15, or to the max zoom of the archive with --pmtiles')
+    parser.add_argument('--tile-extension', default=None, choices=SUPPORTED_FORMATS, help='defaults to webp, or to the tile type of the archive with --pmtiles and --changed-ids')
+    parser.add_argument('--tile-quality', type=int, default=75)
+    parser.add_argument('--workers', type=int, default=None, help='number of tiling processes, defaults to the cpu count')
+    parser.add_argument('--name', default='Soviet-GS-25k')
+    parser.add_argument('--description', default='Soviet GenShtab 1:25,000 Topographic Maps')
+    parser.add_argument('--attribution', default='Russian Topo Maps')
+    parser.add_argument('--no-resume', action='store_true', help='render the tiles which are already present again')
+    parser.add_argument('--no-overviews', action='store_true', help='warp every zoom from the gtiffs instead of downsampling the zooms below the max zoom')
+    parser.add_argument('--changed-ids', nargs='+', help='only retile what these added, replaced or removed sheets touch, the overviews above them are rebuilt from their children')
+    parser.add_argument('--changed-ids-file', help='file with one changed sheet id per line, same as --changed-ids')
+    parser.add_argument('--pmtiles', help='pmtiles archive to write the tiles to instead of the tiles dir, with --changed-ids it is updated in place')
+    args = parser.parse_args()
 
-        if not os.path.exists(sheet_temp_dir):
-            os.makedirs(sheet_temp_dir)
+    changed_ids = get_changed_ids(args)
+    incremental = args.changed_ids is not None or args.changed_ids_file is not None
 
-        try:
-            shutil.copy(os.path.join(gtiffs_dir, tiff_file), sheet_temp_dir)
+    min_zoom, max_zoom = args.min_zoom, args.max_zoom
+    tile_format = args.tile_extension
+    if args.pmtiles is not None and incremental:
+        header = get_pmtiles_header(args.pmtiles)
+        min_zoom = header['min_zoom'] if min_zoom is None else min_zoom
+        max_zoom = header['max_zoom'] if max_zoom is None else max_zoom
+        # the retiled tiles go in with the ones already there, they have to be of the same type
+        archive_format = get_tile_format(header['tile_type'])
+        if tile_format is not None and tile_format != archive_format:
+            parser.error(f'--tile-extension {tile_format} does not match the {archive_format} tiles in {args.pmtiles}')
+        tile_format = archive_format
+        sink = PMTilesUpdateSink(args.pmtiles)
+    elif args.pmtiles is not None:
+        tile_format = tile_format or 'webp'
+        # the whole archive is written again, there is no loose tile tree to resume from
+        sink = PMTilesSink(args.pmtiles, tile_format)
+    else:
+        tile_format = tile_format or 'webp'
+        sink = DirTileSink(Path(args.tiles_dir), tile_format)
+    min_zoom = 15 if min_zoom is None else min_zoom
+    max_zoom = 15 if max_zoom is None else max_zoom
 
-            command = [
-                'uv', 'run', 'tile',
-                '--tiles-dir', tiles_dir,
-                '--tiffs-dir', sheet_temp_dir,
-                '--name', sheet_no,
-                '--description', sheet_no,
-                '--attribution', 'Russian Topo Maps',
-                '--max-zoom', '15',
-                '--min-zoom', '15'
-            ]
-
-            result = subprocess.run(command, capture_output=True, text=True)
-            shutil.rmtree(sheet_temp_dir)
-            shutil.rmtree(temp_dir)
-
-            if result.returncode == 0:
-                successful_count += 1
-            else:
-                failed_sheets.append(sheet_no)
-                print(f"Failed to tile {sheet_no}: {result.stderr}")
-
-        except Exception as e:
-            failed_sheets.append(sheet_no)
-            print(f"An error occurred while processing {sheet_no}: {e}")
-
-        progress = (i + 1) / total_tiffs * 100
-        print(f"Progress: {progress:.2f}% ({i + 1}/{total_tiffs})")
+    if incremental:
+        stats = retile_sheets(args.gtiffs_dir, changed_ids, sink, min_zoom, max_zoom,
+                              tile_format=tile_format, quality=args.tile_quality,
+                              workers=args.workers, overviews=not args.no_overviews)
+    else:
+        stats = tile_tiffs(args.gtiffs_dir, sink, min_zoom, max_zoom,
+                           tile_format=tile_format, quality=args.tile_quality,
+                           workers=args.workers, resume=not args.no_resume,
+                           overviews=not args.no_overviews)
+        sink.close(get_metadata(tile_format, args.name, args.description, args.attribution,
+                                min_zoom, max_zoom))
 
     print("\nTiling complete.")
-    print(f"Successful sheets: {successful_count}")
-    print(f"Failed sheets: {len(failed_sheets)}")
-    if failed_sheets:
-        print("Failed sheet numbers:")
-        for sheet in failed_sheets:
-            print(sheet)
+    print(stats)
+    for zoom in sorted(stats.transparent_by_zoom.keys()):
+        print(f'zoom {zoom}: {stats.transparent_by_zoom[zoom]} fully transparent tiles skipped before encoding')
+    if stats.failed:
+        print("Failed tiles:")
+        for tile, error in stats.failed:
+            print(f'{tile.z}/{tile.x}/{tile.y}: {error}')
+
 
 if __name__ == '__main__':
-    tile_tiffs()
+    main()